@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Benchmark EventHandler.sub_args and the trigger of each action.
+
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+import common
+
+import ire.actions as action_module
+
+templates = {
+  "literal": {"text": "no substitutions at all"},
+  "path": {"text": "%s"},
+  "typical": {"text": "New file %f in %d", "destination": "/tmp/%f.log"},
+  "all": {"text": "%s %f %n %e %d %m"},
+}
+
+
+def bench_sub_args(handler, number):
+  results = []
+  pathname = os.path.abspath(__file__)
+  for name, args in sorted(templates.items()):
+    seconds = common.timed(lambda: handler.sub_args(args, pathname), number)
+    results.append({"template": name, "us_per_call": seconds * 1e6})
+  return results
+
+
+def trigger_args(action_type, work_dir):
+  """
+  Return a function giving the keyword arguments for the nth trigger of
+  an action, or None if the action isn't benchmarked.
+
+  """
+  if action_type == "Alert":
+    return lambda n: {"text": "alert"}
+  if action_type == "Log":
+    log = os.path.join(work_dir, "bench.log")
+    return lambda n: {"text": "a line of log output", "destination": log}
+  if action_type == "Move":
+    a, b = os.path.join(work_dir, "a"), os.path.join(work_dir, "b")
+    open(a, 'w').close()
+    # Move the file back and forth
+    return lambda n: ({"_path": a, "destination": b} if n % 2 == 0 else
+                      {"_path": b, "destination": a})
+  if action_type == "Shell":
+    return lambda n: {"command": "true", "_rule": None}
+  return None
+
+
+def bench_triggers(handler, number):
+  results = []
+  work_dir = tempfile.mkdtemp(prefix="ire-bench-actions-")
+  devnull = open(os.devnull, 'w')
+  try:
+    for action_type in sorted(action_module.action_list):
+      make_args = trigger_args(action_type, work_dir)
+      if make_args is None:
+        continue
+      action = handler.actions[action_type]
+      count = number // 10 if action_type == "Shell" else number
+      calls = [make_args(n) for n in range(count)]
+      threads = threading.active_count()
+      stdout, sys.stdout = sys.stdout, devnull  # Alert prints
+      try:
+        start = time.time()
+        for kwargs in calls:
+          action.trigger(**kwargs)
+        if hasattr(action, "shutdown"):
+          action.shutdown()  # Include writing out anything buffered
+        if action_type == "Shell":
+          # Include running the commands, not just starting them
+          while threading.active_count() > threads:
+            time.sleep(0.001)
+        seconds = time.time() - start
+      finally:
+        sys.stdout = stdout
+      results.append({"action": action_type, "calls": count,
+                      "us_per_call": seconds / count * 1e6})
+      sys.stderr.write("{0}: {1:.1f}us\n".format(
+        action_type, results[-1]["us_per_call"]))
+  finally:
+    devnull.close()
+    shutil.rmtree(work_dir, ignore_errors=True)
+  return results
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("-n", "--number", type=int, default=10000,
+                      help="Calls per benchmark (a tenth of this for Shell).")
+  parser.add_argument("-o", "--output", type=str, default=None,
+                      help="File to write the JSON results to "
+                        "(default stdout).")
+  args = parser.parse_args()
+  settings = common.Settings([], [])
+  try:
+    handler = settings.handler()
+    results = {
+      "sub_args": bench_sub_args(handler, args.number),
+      "trigger": bench_triggers(handler, args.number),
+    }
+    handler.shutdown()
+  finally:
+    settings.close()
+  common.report("actions", results, args.output)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+End to end benchmark: create files in a watched directory (on tmpfs by
+default) and measure how many events per second inotifyhandler.EventHandler
+gets through, and the time from creating each file to the end of its
+action.
+
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+import pyinotify
+
+import common
+
+import ire.inotifyhandler as inotifyhandler
+
+
+class TimedHandler(inotifyhandler.EventHandler):
+  """Records when the action for each file finishes."""
+  def __init__(self, settingsfile):
+    inotifyhandler.EventHandler.__init__(self, settingsfile)
+    self.finished = {}
+
+  def exe(self, action_type, kwdict):
+    ok = inotifyhandler.EventHandler.exe(self, action_type, kwdict)
+    self.finished[kwdict["_path"]] = time.time()
+    return ok
+
+
+def create_files(watch_dir, count, rate, created):
+  """Create count files, at most rate per second (0 for no limit)."""
+  start = time.time()
+  for ix in range(count):
+    if rate:
+      delay = start + float(ix) / rate - time.time()
+      if delay > 0:
+        time.sleep(delay)
+    pathname = os.path.join(watch_dir, "file{0}.dat".format(ix))
+    created[pathname] = time.time()
+    with open(pathname, 'w') as f:
+      f.write("x")
+
+
+def run(base_dir, count, rate, workers, settle_window, timeout):
+  watch_dir = tempfile.mkdtemp(prefix="ire-bench-e2e-", dir=base_dir)
+  settings = common.Settings([{
+    "name": "All",
+    "pattern_condition": "AND",
+    "pattern_list": [{"style": "EndsWithPattern", "pattern": ".dat"}],
+    "actions": [{"type": "Log", "args": {"text": "%s",
+                                         "destination": os.devnull}}],
+  }], [{"location": watch_dir, "rules": ["All"]}], {
+    "workers": workers,
+    "settle_window": settle_window,
+  })
+  try:
+    handler = settings.handler(TimedHandler)
+    wm = pyinotify.WatchManager()
+    notifier = pyinotify.Notifier(wm, handler, timeout=100)
+    handler.add_watches(wm)
+    created = {}
+    writer = threading.Thread(target=create_files,
+                              args=(watch_dir, count, rate, created))
+    start = time.time()
+    writer.start()
+    while len(handler.finished) < count and time.time() - start < timeout:
+      if notifier.check_events():
+        notifier.read_events()
+        notifier.process_events()
+      handler.settle.run_due()
+    elapsed = time.time() - start
+    writer.join()
+    handler.shutdown()
+    notifier.stop()
+  finally:
+    settings.close()
+    shutil.rmtree(watch_dir, ignore_errors=True)
+  latencies = [handler.finished[path] - created[path]
+               for path in handler.finished if path in created]
+  return {
+    "files": count,
+    "handled": len(handler.finished),
+    "rate_limit": rate,
+    "workers": workers,
+    "settle_window": settle_window,
+    "directory": base_dir,
+    "seconds": elapsed,
+    "events_per_second": len(handler.finished) / elapsed,
+    "latency_p50_ms": (common.percentile(latencies, 0.5) or 0) * 1000,
+    "latency_p99_ms": (common.percentile(latencies, 0.99) or 0) * 1000,
+    "latency_max_ms": max(latencies or [0]) * 1000,
+  }
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("-d", "--dir", type=str, default="/dev/shm",
+                      help="Directory to create the watched directory in "
+                        "(default /dev/shm, a tmpfs).")
+  parser.add_argument("-n", "--files", type=int, default=10000,
+                      help="Number of files to create.")
+  parser.add_argument("--rate", type=float, default=0,
+                      help="Files created per second (default: as fast as "
+                        "possible).")
+  parser.add_argument("--workers", type=int, default=4,
+                      help="Action worker threads.")
+  parser.add_argument("--settle-window", type=float, default=0,
+                      dest="settle_window", help="The settle_window option.")
+  parser.add_argument("--timeout", type=float, default=300,
+                      help="Give up after this many seconds.")
+  parser.add_argument("-o", "--output", type=str, default=None,
+                      help="File to write the JSON results to "
+                        "(default stdout).")
+  args = parser.parse_args()
+  common.report("e2e", run(args.dir, args.files, args.rate, args.workers,
+                           args.settle_window, args.timeout), args.output)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Benchmark EventHandler.matches with synthetic rulesets of increasing size,
+using a mix of every pattern style, against files on disk.
+
+"""
+import os
+import sys
+import pwd
+import time
+import shutil
+import argparse
+import tempfile
+
+import common
+
+import ire.patterns as pattern_module
+
+
+def pattern_for(style, ix, files_dir):
+  """Return a pattern string of the given style, varying with ix."""
+  return {
+    "RegexPattern": r"^file_{0}_\d+\.txt$".format(ix),
+    "SimplePattern": "*_{0}.log".format(ix),
+    "StartsWithPattern": "file_{0}_".format(ix % 100),
+    "EndsWithPattern": ".ext{0}".format(ix % 50),
+    "MimetypePattern": ("image/png", "text/plain", "application/json")[ix % 3],
+    "MagicMimetypePattern": ("image/png", "application/pdf")[ix % 2],
+    "SizeGreaterPattern": "{0}K".format(ix % 10),
+    "SizeLessPattern": "{0}K".format(ix % 10 + 1),
+    "OlderThanPattern": "{0}d".format(ix % 30 + 1),
+    "NewerThanPattern": "{0}h".format(ix % 24 + 1),
+    "OwnerPattern": pwd.getpwuid(os.getuid()).pw_name,
+    "PermissionsPattern": "644",
+    "DuplicatePattern": files_dir,
+  }[style]
+
+
+def make_rules(count, files_dir):
+  """
+  Build count rules. Each has a cheap filename pattern and, for most, a
+  second pattern cycling through the other styles, ANDed or ORed.
+
+  """
+  styles = pattern_module.pattern_list
+  name_styles = ["RegexPattern", "SimplePattern", "StartsWithPattern",
+                 "EndsWithPattern"]
+  rules = []
+  for ix in range(count):
+    patterns = [{"style": name_styles[ix % len(name_styles)],
+                 "pattern": pattern_for(name_styles[ix % len(name_styles)],
+                                        ix, files_dir)}]
+    if ix % 4:
+      style = styles[ix % len(styles)]
+      patterns.append({"style": style,
+                       "pattern": pattern_for(style, ix, files_dir)})
+    rules.append({
+      "name": "rule{0}".format(ix),
+      "pattern_condition": "OR" if ix % 5 == 0 else "AND",
+      "pattern_list": patterns,
+      "actions": [{"type": "Alert", "args": {"text": "%s"}}],
+    })
+  return rules
+
+
+def make_files(files_dir, count):
+  """Create count files with a spread of names, sizes and contents."""
+  headers = ["\x89PNG\r\n\x1a\n", "%PDF-1.4\n", "{\"a\": 1}\n", "plain text\n"]
+  exts = [".txt", ".log", ".png", ".json"] + [".ext{0}".format(ix)
+                                               for ix in range(5)]
+  names = []
+  for ix in range(count):
+    name = "file_{0}_{1}{2}".format(ix % 150, ix, exts[ix % len(exts)])
+    with open(os.path.join(files_dir, name), 'wb') as f:
+      f.write(headers[ix % len(headers)] + "x" * (ix * 97 % 12000))
+    names.append(name)
+  return names
+
+
+def run(sizes, file_count, rounds):
+  files_dir = tempfile.mkdtemp(prefix="ire-bench-files-")
+  results = []
+  try:
+    names = make_files(files_dir, file_count)
+    for size in sizes:
+      rules = make_rules(size, files_dir)
+      settings = common.Settings(rules, [{"location": files_dir, "rules":
+        [rule["name"] for rule in rules]}], {
+          "workers": 0
+        })
+      pattern_module.DuplicatePattern.configure(
+        index=os.path.join(settings.dir, "hashes.db"))
+      try:
+        start = time.time()
+        handler = settings.handler()
+        load = time.time() - start
+        matched = 0
+        times = []
+        for round in range(rounds):
+          start = time.time()
+          for name in names:
+            matched += len(handler.matches(files_dir, name))
+          times.append(time.time() - start)
+        handler.shutdown()
+      finally:
+        settings.close()
+      best = min(times)
+      results.append({
+        "rules": size,
+        "patterns": len(handler.engine.ids),
+        "files": file_count,
+        "load_seconds": load,
+        "matches_per_second": file_count / best,
+        "us_per_match": best / file_count * 1e6,
+        "median_round_seconds": common.percentile(times, 0.5),
+        "rules_matched_per_file": float(matched) / (file_count * rounds),
+      })
+      sys.stderr.write("{0} rules: {1:.0f} matches/s\n".format(
+        size, results[-1]["matches_per_second"]))
+  finally:
+    shutil.rmtree(files_dir, ignore_errors=True)
+  return results
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument("--sizes", type=str, default="10,100,1000,10000",
+                      help="Comma separated ruleset sizes.")
+  parser.add_argument("--files", type=int, default=500,
+                      help="Number of files to match.")
+  parser.add_argument("--rounds", type=int, default=5,
+                      help="Times to match every file; the best is kept.")
+  parser.add_argument("-o", "--output", type=str, default=None,
+                      help="File to write the JSON results to "
+                        "(default stdout).")
+  args = parser.parse_args()
+  common.report("matching", run([int(size) for size in
+    args.sizes.split(",")], args.files, args.rounds), args.output)
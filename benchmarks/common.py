@@ -0,0 +1,77 @@
+"""Helpers shared by the benchmarks."""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ire.eventhandler as eventhandler
+
+
+def percentile(values, fraction):
+  """Return the value below which fraction of values fall."""
+  if not values:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def timed(func, number):
+  """Run func number times and return the seconds taken per run."""
+  start = time.time()
+  for ix in xrange(number):
+    func()
+  return (time.time() - start) / number
+
+
+def revision():
+  """Return the git revision of the tree being benchmarked, if known."""
+  try:
+    return subprocess.check_output(
+      ["git", "rev-parse", "--short", "HEAD"],
+      cwd=os.path.dirname(os.path.abspath(__file__)),
+      stderr=open(os.devnull, 'w')).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def report(name, results, output=None):
+  """Write the results of a benchmark as JSON, to output or stdout."""
+  data = {
+    "benchmark": name,
+    "revision": revision(),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "results": results,
+  }
+  text = json.dumps(data, indent=2, sort_keys=True) + "\n"
+  if output:
+    with open(output, 'w') as f:
+      f.write(text)
+  else:
+    sys.stdout.write(text)
+
+
+class Settings(object):
+  """A settings file in a temporary directory, removed afterwards."""
+  def __init__(self, rules, watches, options=None):
+    self.dir = tempfile.mkdtemp(prefix="ire-bench-")
+    self.path = os.path.join(self.dir, "settings.json")
+    with open(self.path, 'w') as f:
+      json.dump({
+        "rules": rules,
+        "watches": watches,
+        "options": options or {"workers": 0},
+      }, f)
+
+  def handler(self, cls=eventhandler.EventHandler):
+    return cls(self.path)
+
+  def close(self):
+    shutil.rmtree(self.dir, ignore_errors=True)
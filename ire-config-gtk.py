@@ -448,6 +448,7 @@ class IreUI(gtk.Window):
     self.watch_model = gtk.ListStore(str, object)  # (String-watch, Watch dict)
     self.watch_model.connect("row_changed", mark_unsaved)
     self.watch_model.connect("row_inserted", mark_unsaved)
+    self.extra_settings = {}  # Daemon options, preserved when saving
     
     menu_box = gtk.VBox()
     menu_box.pack_start(self.item_factory.get_widget("<main>"), expand=False)
@@ -680,6 +681,8 @@ class IreUI(gtk.Window):
       if "watches" in settings:
         for watch in settings["watches"]:
           self.watch_model.append(self.build_watch_model_row(watch))
+      self.extra_settings = dict((key, value) for key, value in
+        settings.items() if key not in ("rules", "watches"))
       self.unsaved_edits = False
   
   def save_if_necessary(self, *args):
@@ -720,7 +723,8 @@ class IreUI(gtk.Window):
     else:
       try:
         with open(self.loaded_file, 'w') as f:
-          obj = { "rules": [], "watches": [] }
+          obj = dict(self.extra_settings)
+          obj.update({ "rules": [], "watches": [] })
           for rule in self.rule_model:
             obj["rules"].append(rule[1])
           for watch in self.watch_model:
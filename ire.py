@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import os
 import sys
 import argparse
 
@@ -41,25 +40,62 @@ if __name__ == "__main__":
                       default=None,
                       help="List of custom rules to run immediately without "
                         "starting the event handler.")
+  parser.add_argument('-j', "--jobs", action="store", dest="jobs", type=int,
+                      default=1,
+                      help="Number of processes matching files and running "
+                        "actions for custom rules (-r option). Defaults to 1.")
+  parser.add_argument("--recursive", action="store_true", dest="recursive",
+                      default=False,
+                      help="Run custom rules (-r option) on files in every "
+                        "directory below --dir as well.")
+  parser.add_argument("--progress", action="store", dest="progress",
+                      type=float, default=5.0,
+                      help="Seconds between progress reports for custom "
+                        "rules (-r option). 0 disables them. Defaults to 5.")
+  parser.add_argument('-b', "--backend", action="store", dest="backend",
+                      choices=["inotify", "async"], default="inotify",
+                      help="How filesystem events are read (Linux only). "
+                        "'async' runs them on an event loop that can wait "
+                        "on many Shell actions without a thread for each. "
+                        "Defaults to inotify.")
+  parser.add_argument("--record", action="store", dest="record", type=str,
+                      default=None,
+                      help="Append every inotify event the daemon receives "
+                        "to this trace file, for --replay.")
+  parser.add_argument("--replay", action="store", dest="replay", type=str,
+                      default=None,
+                      help="Feed the events in a trace file recorded with "
+                        "--record through the config's rules instead of "
+                        "watching anything. Actions are counted, not run.")
+  parser.add_argument("--speed", action="store", dest="speed", type=float,
+                      default=1.0,
+                      help="Speed to replay a trace at (--replay): 1 is the "
+                        "speed it was recorded at, 2 twice as fast, 0 as "
+                        "fast as possible. Defaults to 1.")
   args = parser.parse_args()
 
   if args.rules:
-    handler = ire.eventhandler.EventHandler(args.configfile)
-    # Replace the default watches with provided custom watch.
-    handler.watches = [{
-      "location": args.dir,
-      "rules": args.rules
-    }]
-    path = os.path.expanduser(args.dir)
-    for filename in os.listdir(path):
-      rules = handler.matches(path, filename)
-      handler.do_actions(rules, os.path.join(path, filename))
+    import ire.batch
+    # The custom rules replace the configured watches for --dir.
+    batch = ire.batch.Batch(args.configfile, args.dir, args.rules,
+                            jobs=args.jobs, recursive=args.recursive,
+                            progress=args.progress)
+    batch.run()
+  elif args.replay:
+    import ire.replay
+    ire.replay.Replayer(args.configfile, args.replay, speed=args.speed).run()
   else:
     platform = ire.autoplatform.platform
-    if platform == "linux":  # Detect Linux here:
+    if platform == "linux" and args.backend == "async":
+      import ire.asynchandler
+      handler = ire.asynchandler.EventHandler(args.configfile)
+    elif platform == "linux":  # Detect Linux here:
       import ire.inotifyhandler
       handler = ire.inotifyhandler.EventHandler(args.configfile)
     else:
       sys.stderr.write("Platform '{0}' not supported.\n".format(platform))
       sys.exit(1)
+    if args.record:
+      import ire.replay
+      handler.recorder = ire.replay.Recorder(args.record)
     handler.start()
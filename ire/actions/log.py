@@ -1,9 +1,199 @@
+import os
+import atexit
+import threading
+import collections
+
+
+class Writer(object):
+  """
+  A log file kept open for appending. Lines are buffered and written
+  whole, under a lock, so lines from different threads never interleave.
+
+  """
+  def __init__(self, path):
+    self.path = path
+    self.lock = threading.Lock()
+    self.buffer = []
+    self.buffered = 0
+    self.closed = False
+    self.file = None
+    self.open()
+
+  def open(self):
+    self.file = open(self.path, 'a')
+    self.size = os.fstat(self.file.fileno()).st_size
+
+  def write(self, line, pool):
+    """Buffer a line. Returns False if the writer was closed meanwhile."""
+    with self.lock:
+      if self.closed:
+        return False
+      if pool.max_bytes and self.size + self.buffered >= pool.max_bytes:
+        self._rotate(pool.backups)
+      self.buffer.append(line)
+      self.buffered += len(line)
+      if self.buffered >= pool.buffer_size:
+        self._flush()
+      return True
+
+  def flush(self):
+    with self.lock:
+      if not self.closed:
+        self._flush()
+
+  def _flush(self):
+    if self.buffer:
+      data = "".join(self.buffer)
+      self.buffer = []
+      self.buffered = 0
+      self.file.write(data)
+      self.file.flush()
+      self.size += len(data)
+
+  def _rotate(self, backups):
+    """Move the file to path.1 (and so on) and start a new one."""
+    self._flush()
+    self.file.close()
+    for ix in range(backups - 1, 0, -1):
+      if os.path.exists("{0}.{1}".format(self.path, ix)):
+        os.rename("{0}.{1}".format(self.path, ix),
+                  "{0}.{1}".format(self.path, ix + 1))
+    if backups:
+      os.rename(self.path, self.path + ".1")
+    else:
+      os.unlink(self.path)
+    self.open()
+
+  def reopen(self):
+    """Start writing to whatever file is at the path now."""
+    with self.lock:
+      if not self.closed:
+        self._flush()
+        self.file.close()
+        self.open()
+
+  def close(self):
+    with self.lock:
+      if not self.closed:
+        self._flush()
+        self.file.close()
+        self.closed = True
+
+
+class WriterPool(object):
+  """
+  Open log files shared by every Log action.
+
+  At most max_open files are kept open; the least recently used is
+  flushed and closed to make room for another. Lines are written out
+  once buffer_size bytes are waiting for a file, and by a background
+  thread every flush_interval seconds, so a line reaches the file at most
+  that long after it was logged. Files reaching max_bytes are rotated,
+  keeping `backups` old files, and every file is reopened when the daemon
+  gets a SIGHUP (for rotation by another program). At exit (or close()),
+  the thread is stopped and everything is written out.
+
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.writers = collections.OrderedDict()
+    self.thread = None
+    self.stopped = threading.Event()
+    self.hangup = False
+    self.configure()
+    atexit.register(self.close)
+
+  def configure(self, max_open=64, buffer_size=65536, flush_interval=1.0,
+                max_bytes=None, backups=1):
+    self.max_open = max_open
+    self.buffer_size = buffer_size
+    self.flush_interval = flush_interval
+    self.max_bytes = max_bytes
+    self.backups = backups
+
+  def reopen(self):
+    """Have every file reopened (safe to call from a signal handler)."""
+    # Reopening takes locks, so leave it to the flusher thread
+    self.hangup = True
+
+  def writer(self, path):
+    """Return the open writer for a path, opening it if necessary."""
+    evicted = []
+    with self.lock:
+      writer = self.writers.pop(path, None)
+      if writer is None:
+        writer = Writer(path)
+        while len(self.writers) >= self.max_open:
+          evicted.append(self.writers.popitem(last=False)[1])
+      self.writers[path] = writer
+      if self.thread is None:
+        self.thread = threading.Thread(target=self._flusher,
+                                       args=(self.stopped,),
+                                       name="ire-log-flusher")
+        self.thread.daemon = True
+        self.thread.start()
+    for old in evicted:
+      old.close()
+    return writer
+
+  def write(self, path, line):
+    while not self.writer(path).write(line, self):
+      pass  # Closed to make room for another file; open it again
+
+  def _flusher(self, stopped):
+    while not stopped.wait(self.flush_interval):
+      with self.lock:
+        writers = list(self.writers.values())
+      hangup, self.hangup = self.hangup, False
+      for writer in writers:
+        try:
+          if hangup:
+            writer.reopen()
+          else:
+            writer.flush()
+        except (IOError, OSError) as e:
+          print "Could not write log {0}: {1}".format(writer.path, e)
+
+  def flush(self):
+    with self.lock:
+      writers = list(self.writers.values())
+    for writer in writers:
+      writer.flush()
+
+  def close(self):
+    """Stop the flusher thread, then write out and close every file."""
+    with self.lock:
+      thread, self.thread = self.thread, None
+      stopped, self.stopped = self.stopped, threading.Event()
+      writers = list(self.writers.values())
+      self.writers.clear()
+    if thread is not None:
+      stopped.set()
+      thread.join()
+    for writer in writers:
+      writer.close()
+
+
+pool = WriterPool()
+
+
 class Log(object):
   displayname = "Log"
   form_display = [("text", "with message", "Text to write to the log file."),
                   ("destination", "to", "File path to append to.")]
 
+  @staticmethod
+  def configure(**options):
+    pool.configure(**options)
+
   @staticmethod
   def trigger(**kwargs):
-    with open(kwargs["destination"], 'a') as f:
-      f.write(kwargs["text"] + '\n')
+    pool.write(kwargs["destination"], kwargs["text"] + '\n')
+
+  @staticmethod
+  def reopen():
+    pool.reopen()
+
+  @staticmethod
+  def shutdown():
+    pool.close()
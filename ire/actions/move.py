@@ -1,10 +1,239 @@
+import os
+import errno
 import shutil
-        
+import threading
+import collections
+
+try:
+  import ctypes
+  import ctypes.util
+  _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except (ImportError, OSError):
+  _libc = None
+
+
+def _libc_func(names, restype, argtypes):
+  """Return the first of names that libc has, set up for ctypes, or None."""
+  for name in names:
+    func = getattr(_libc, name, None)
+    if func is not None:
+      func.restype = restype
+      func.argtypes = argtypes
+      return func
+  return None
+
+
+def _call(func, *args):
+  """Call a libc function, retrying on EINTR and raising OSError on errors."""
+  while True:
+    result = func(*args)
+    if result >= 0:
+      return result
+    err = ctypes.get_errno()
+    if err != errno.EINTR:
+      raise OSError(err, os.strerror(err))
+
+
+# The in-kernel copy and preallocation calls, as in Python 3's os module.
+# Python 2's os has none of them, so they are bound from libc instead.
+copy_file_range = getattr(os, "copy_file_range", None)
+sendfile = getattr(os, "sendfile", None)
+posix_fallocate = getattr(os, "posix_fallocate", None)
+if _libc is not None:
+  if copy_file_range is None:
+    _copy_file_range = _libc_func(["copy_file_range"], ctypes.c_ssize_t,
+      [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+       ctypes.c_size_t, ctypes.c_uint])
+    if _copy_file_range is not None:
+      def copy_file_range(src, dst, count):
+        return _call(_copy_file_range, src, None, dst, None, count, 0)
+  if sendfile is None:
+    _sendfile = _libc_func(["sendfile64", "sendfile"], ctypes.c_ssize_t,
+      [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+    if _sendfile is not None:
+      def sendfile(out_fd, in_fd, offset, count):
+        return _call(_sendfile, out_fd, in_fd, None, count)
+  if posix_fallocate is None:
+    # fallocate, unlike posix_fallocate, fails instead of writing zeros
+    # where the filesystem can't reserve space.
+    _fallocate = _libc_func(["fallocate64", "fallocate"], ctypes.c_int,
+      [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64])
+    if _fallocate is not None:
+      def posix_fallocate(fd, offset, length):
+        _call(_fallocate, fd, 0, offset, length)
+
+
+class Mover(object):
+  """
+  Moves files for the Move action.
+
+  A move is a rename whenever the destination is on the same filesystem.
+  Across filesystems the file is copied in the kernel where the platform
+  allows it (copy_file_range, then sendfile, from libc if os doesn't
+  have them), falling back to large read/write blocks, into space
+  preallocated for the whole file, and the source is removed once the
+  copy is complete. With fsync on, the moved file and both directories
+  are synced before the move counts as done, in an order that leaves the
+  file in at least one of them after a crash; descriptors for the most
+  recently used directories are kept open so that syncing a busy
+  destination doesn't cost a path lookup every time.
+  Otherwise behaves like shutil.move.
+
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.dirs = collections.OrderedDict()
+    self.configure()
+
+  def configure(self, fsync=False, preallocate=True, max_dir_fds=64,
+                block_size=1 << 20):
+    with self.lock:
+      self.fsync = fsync
+      self.preallocate = preallocate
+      self.max_dir_fds = max_dir_fds
+      self.block_size = block_size
+      self._close_dirs(0)
+
+  def move(self, src, dst):
+    """Move src to dst, or into dst if it is a directory."""
+    if os.path.isdir(dst):
+      dst = os.path.join(dst, os.path.basename(src.rstrip(os.path.sep)))
+      if os.path.exists(dst):
+        raise shutil.Error("Destination path '{0}' already exists".format(dst))
+    src_dir = os.path.dirname(os.path.abspath(src))
+    dst_dir = os.path.dirname(os.path.abspath(dst))
+    if self.fsync and os.stat(src_dir).st_dev == os.stat(dst_dir).st_dev:
+      self.sync_file(src)  # Its data is on disk before its new name is
+    try:
+      os.rename(src, dst)
+    except OSError as e:
+      if e.errno != errno.EXDEV:
+        raise
+      if os.path.isdir(src) and not os.path.islink(src):
+        shutil.move(src, dst)
+      else:
+        self.copy(src, dst)
+        # The copy is on disk before the original is removed
+        if self.fsync:
+          self.sync_dir(dst_dir)
+        os.unlink(src)
+        if self.fsync:
+          self.sync_dir(src_dir)
+        return
+    if self.fsync:
+      self.sync_dir(dst_dir)
+      self.sync_dir(src_dir)
+
+  @staticmethod
+  def sync_file(path):
+    """fsync a file (or directory), but not through a symlink."""
+    if os.path.islink(path):
+      return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+  def copy(self, src, dst):
+    """Copy a file's contents and metadata, removing dst if it fails."""
+    if os.path.islink(src):
+      os.symlink(os.readlink(src), dst)
+      return
+    infd = os.open(src, os.O_RDONLY)
+    try:
+      st = os.fstat(infd)
+      outfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                      st.st_mode & 0o7777)
+      try:
+        try:
+          self._copy(infd, outfd, st.st_size)
+          if self.fsync:
+            os.fsync(outfd)
+        finally:
+          os.close(outfd)
+        shutil.copystat(src, dst)
+      except:
+        try:
+          os.unlink(dst)
+        except OSError:
+          pass
+        raise
+    finally:
+      os.close(infd)
+
+  def _copy(self, infd, outfd, size):
+    if self.preallocate and posix_fallocate is not None and size:
+      try:
+        posix_fallocate(outfd, 0, size)
+      except OSError:
+        pass  # Not supported by the filesystem; the copy still works
+
+    if copy_file_range is not None:
+      try:
+        self._copy_with(lambda count: copy_file_range(infd, outfd, count))
+        return
+      except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                           errno.EOPNOTSUPP):
+          raise
+        os.lseek(infd, 0, os.SEEK_SET)
+        os.lseek(outfd, 0, os.SEEK_SET)
+
+    if sendfile is not None:
+      try:
+        self._copy_with(lambda count: sendfile(outfd, infd, None, count))
+        return
+      except OSError as e:
+        if e.errno not in (errno.ENOSYS, errno.EINVAL):
+          raise
+        os.lseek(infd, 0, os.SEEK_SET)
+        os.lseek(outfd, 0, os.SEEK_SET)
+
+    while True:
+      block = os.read(infd, self.block_size)
+      if not block:
+        break
+      while block:
+        block = block[os.write(outfd, block):]
+
+  def _copy_with(self, copy):
+    """Call copy(count) until it reports the end of the file."""
+    block_size = max(self.block_size, 1 << 24)
+    while copy(block_size):
+      pass
+
+  def sync_dir(self, path):
+    """fsync a directory, through a cached descriptor."""
+    with self.lock:
+      fd = self.dirs.pop(path, None)
+      if fd is None:
+        fd = os.open(path, os.O_RDONLY)
+      self.dirs[path] = fd
+      self._close_dirs(self.max_dir_fds)
+      # Sync a duplicate, so the cached one can be closed meanwhile
+      fd = os.dup(fd)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+  def _close_dirs(self, keep):
+    while len(self.dirs) > keep:
+      os.close(self.dirs.popitem(last=False)[1])
+
+
+mover = Mover()
+
 
 class Move(object):
   displayname = "Move file"
   form_display = [("destination", "to", "Destination path and filename."), ]
-  
+
+  @staticmethod
+  def configure(**options):
+    mover.configure(**options)
+
   @staticmethod
   def trigger(**kwargs):
-    shutil.move(kwargs["_path"], kwargs["destination"])
+    mover.move(kwargs["_path"], kwargs["destination"])
@@ -1,6 +1,317 @@
+import os
 import sys
+import time
 import shlex
+import select
+import signal
+import asyncore
+import threading
 import subprocess
+import collections
+
+
+class Supervisor(object):
+  """
+  Starts the commands run by the Shell action and looks after them until
+  they exit: each child is reaped by its own supervising thread, the
+  number of running commands is capped globally and per rule, commands
+  running longer than the timeout are killed along with everything they
+  started (each command runs in its own session), and the exit status
+  and the first output_limit bytes of output are kept in self.results.
+  A command counts as running until it exits, even if something it
+  started in the background still holds its output open.
+  A command over either cap waits in self.waiting, without holding up
+  whoever started it, until a running command exits.
+
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.results = collections.deque(maxlen=100)
+    self.waiting = collections.deque()  # (command, rule, loop, done)
+    self.running = 0
+    self.per_rule = {}  # rule -> number of its commands running
+    self.configure()
+
+  def configure(self, max_running=16, max_per_rule=4, timeout=None,
+                output_limit=4096):
+    """
+    Set the limits for commands started from now on. Commands that are
+    already running count towards the new caps.
+    A max_running, max_per_rule or timeout of None means no limit.
+
+    """
+    with self.lock:
+      self.max_running = max_running
+      self.max_per_rule = max_per_rule
+      self.timeout = timeout
+      self.output_limit = output_limit
+    self._run_waiting()  # The caps may have gone up
+
+  def _take(self, rule):
+    """
+    Count a command for a rule as running, if that keeps it under the
+    caps. Returns False otherwise. Called with the lock held.
+
+    """
+    if self.max_running and self.running >= self.max_running:
+      return False
+    if (self.max_per_rule and rule is not None and
+        self.per_rule.get(rule, 0) >= self.max_per_rule):
+      return False
+    self.running += 1
+    if rule is not None:
+      self.per_rule[rule] = self.per_rule.get(rule, 0) + 1
+    return True
+
+  def _release(self, rule):
+    """Stop counting a command as running and start any that now fit."""
+    with self.lock:
+      self.running -= 1
+      if rule is not None:
+        self.per_rule[rule] -= 1
+        if not self.per_rule[rule]:
+          del self.per_rule[rule]
+    self._run_waiting()
+
+  def run(self, command, rule=None, done=None):
+    """
+    Start a command, or leave it waiting if too many commands are already
+    running. Never waits itself. done, if given, is called from the
+    supervising thread with None once the command has exited, or with
+    the error if a waiting command can't be started.
+
+    """
+    with self.lock:
+      if not self._take(rule):
+        self.waiting.append((command, rule, None, done))
+        return
+    self._start(command, rule, done)
+
+  @staticmethod
+  def _popen(command):
+    return subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, close_fds=True,
+                            preexec_fn=os.setsid)
+
+  def _start(self, command, rule, done):
+    """Start a command counted as running, with a thread to supervise it."""
+    try:
+      proc = self._popen(command)
+    except:
+      self._release(rule)
+      raise
+    thread = threading.Thread(target=self._supervise,
+                              args=(proc, command, rule, done))
+    thread.daemon = True
+    thread.start()
+
+  def _supervise(self, proc, command, rule, done=None):
+    killed = []
+    deadline = None
+    if self.timeout:
+      deadline = time.time() + self.timeout
+    try:
+      output = self._read(proc, deadline, killed)
+      status = proc.returncode
+    finally:
+      self._release(rule)
+    self._finish(command, rule, status, output, killed)
+    if done is not None:
+      done()
+
+  def run_async(self, loop, command, rule, done):
+    """
+    Start a command from an event loop (see ire.asynchandler) without
+    blocking. If too many commands are running, the command waits in
+    self.waiting and is started on the loop once there is room.
+    done is called with None, or the error, once the command has exited.
+
+    """
+    with self.lock:
+      if not self._take(rule):
+        self.waiting.append((command, rule, loop, done))
+        return
+    self._start_async(loop, command, rule, done)
+
+  def _start_async(self, loop, command, rule, done):
+    try:
+      proc = self._popen(command)
+    except Exception as e:
+      self._release(rule)
+      done(e)
+      return
+    ProcessChannel(self, loop, proc, command, rule, done)
+
+  def _run_waiting(self):
+    """Start the waiting commands that fit under the caps, oldest first."""
+    ready = []
+    with self.lock:
+      for ix in range(len(self.waiting)):
+        entry = self.waiting.popleft()
+        if self._take(entry[1]):
+          ready.append(entry)
+        else:
+          self.waiting.append(entry)
+    for command, rule, loop, done in ready:
+      if loop is not None:
+        loop.call_soon_threadsafe(self._start_async, loop, command, rule,
+                                  done)
+        continue
+      try:
+        self._start(command, rule, done)
+      except Exception as e:
+        if done is not None:
+          done(e)
+        else:
+          print "Could not start command '{0}': {1}".format(command, e)
+
+  def shutdown(self):
+    """Wait until every command started without a loop has been started."""
+    while True:
+      with self.lock:
+        if not any(entry[2] is None for entry in self.waiting):
+          return
+      time.sleep(0.1)
+
+  def _finish(self, command, rule, status, output, killed):
+    self.results.append({
+      "command": command,
+      "rule": rule,
+      "status": status,
+      "timed_out": bool(killed),
+      "output": output,
+    })
+    if killed:
+      print "Command '{0}' killed after {1} seconds.".format(command,
+                                                             self.timeout)
+    elif status != 0:
+      print "Command '{0}' exited with status {1}.".format(command, status)
+
+  def _read(self, proc, deadline, killed):
+    """
+    Read the command's output until it exits, keeping only the first
+    output_limit bytes, and kill it if it is still running at the
+    deadline. Whatever it wrote before exiting is kept, but the output
+    isn't read any further once it has exited.
+
+    """
+    fd = proc.stdout.fileno()
+    limit = self.output_limit
+    chunks = []
+    kept = 0
+    eof = False
+    while proc.poll() is None:
+      if deadline is not None and not killed and time.time() >= deadline:
+        self._kill(proc, killed)
+      if eof:
+        if deadline is None:
+          proc.wait()
+        else:
+          time.sleep(0.05)
+        continue
+      if not select.select([fd], [], [], 0.05)[0]:
+        continue
+      chunk = os.read(fd, 4096)
+      eof = not chunk
+      if kept < limit:
+        chunks.append(chunk[:limit - kept])
+        kept += len(chunks[-1])
+    while not eof and kept < limit and select.select([fd], [], [], 0)[0]:
+      chunk = os.read(fd, 4096)
+      eof = not chunk
+      chunks.append(chunk[:limit - kept])
+      kept += len(chunks[-1])
+    proc.stdout.close()
+    return ''.join(chunks)
+
+  @staticmethod
+  def _kill(proc, killed):
+    """Kill a running command and everything it started."""
+    if proc.poll() is None:
+      killed.append(True)
+      try:
+        os.killpg(proc.pid, signal.SIGKILL)
+      except OSError:
+        pass  # Exited in the meantime
+
+
+class ProcessChannel(asyncore.file_dispatcher):
+  """
+  Reads a command's output on an event loop and reaps it on exit. The
+  exit is polled for separately, since something the command started in
+  the background can hold the output open long after it has exited.
+
+  """
+  def __init__(self, supervisor, loop, proc, command, rule, done):
+    asyncore.file_dispatcher.__init__(self, proc.stdout.fileno(),
+                                      map=loop.map)
+    proc.stdout.close()  # file_dispatcher reads from its own dup of the fd
+    self.supervisor = supervisor
+    self.loop = loop
+    self.proc = proc
+    self.command = command
+    self.rule = rule
+    self.done = done
+    self.chunks = []
+    self.kept = 0
+    self.killed = []
+    self.reading = True
+    self.timer = None
+    if supervisor.timeout:
+      self.timer = loop.call_later(supervisor.timeout, supervisor._kill,
+                                   proc, self.killed)
+    self.poller = loop.call_later(0.05, self.reap)
+
+  def writable(self):
+    return False
+
+  def readable(self):
+    return self.reading
+
+  def handle_read(self):
+    self.keep(self.recv(4096))
+
+  def handle_close(self):
+    self.stop_reading()
+    # Usually the command has just exited, so check at once.
+    self.loop.cancel(self.poller)
+    self.reap()
+
+  def keep(self, chunk):
+    limit = self.supervisor.output_limit
+    if chunk and self.kept < limit:
+      self.chunks.append(chunk[:limit - self.kept])
+      self.kept += len(self.chunks[-1])
+
+  def stop_reading(self):
+    if self.reading:
+      self.reading = False
+      self.close()
+
+  def reap(self):
+    status = self.proc.poll()
+    if status is None:
+      self.poller = self.loop.call_later(0.05, self.reap)
+      return
+    # Keep what it wrote before exiting, but no more than that.
+    while self.reading and self.kept < self.supervisor.output_limit:
+      try:
+        chunk = self.socket.recv(4096)
+      except OSError:
+        break  # Nothing left to read
+      if not chunk:
+        break
+      self.keep(chunk)
+    self.stop_reading()
+    if self.timer is not None:
+      self.loop.cancel(self.timer)
+    self.supervisor._release(self.rule)
+    self.supervisor._finish(self.command, self.rule, status,
+                            ''.join(self.chunks), self.killed)
+    self.done()
+
+
+supervisor = Supervisor()
 
 
 class Shell(object):
@@ -8,11 +319,29 @@ class Shell(object):
   form_display = [("command", "the shell command",
                               "Full text of command to execute."),
                   ]
-  
+
+  @staticmethod
+  def configure(**options):
+    supervisor.configure(**options)
+
   @staticmethod
   def trigger(**kwargs):
     if sys.version_info.major < 3:
       # Unicode strings don't work in Popen in 2.x, encode to ascii
       kwargs["command"] = kwargs["command"].encode('ascii', 'ignore')
 
-    p = subprocess.Popen(shlex.split(kwargs["command"]))
+    supervisor.run(kwargs["command"], kwargs.get("_rule"))
+
+  @staticmethod
+  def trigger_async(loop, done, **kwargs):
+    if sys.version_info.major < 3:
+      kwargs["command"] = kwargs["command"].encode('ascii', 'ignore')
+
+    if loop is None:
+      supervisor.run(kwargs["command"], kwargs.get("_rule"), done)
+    else:
+      supervisor.run_async(loop, kwargs["command"], kwargs.get("_rule"), done)
+
+  @staticmethod
+  def shutdown():
+    supervisor.shutdown()
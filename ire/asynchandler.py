@@ -0,0 +1,189 @@
+import os
+import time
+import errno
+import fcntl
+import signal
+import heapq
+import asyncore
+import itertools
+import collections
+import pyinotify
+
+import ire.inotifyhandler as inotifyhandler
+
+
+class Waker(asyncore.file_dispatcher):
+  """The read end of a pipe that other threads write to to wake a Loop."""
+  def __init__(self, loop):
+    rfd, self.wfd = os.pipe()
+    asyncore.file_dispatcher.__init__(self, rfd, map=loop.map)
+    os.close(rfd)  # file_dispatcher reads from its own dup of the fd
+    for fd in (self.socket.fd, self.wfd):
+      flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+      fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+  def wake(self):
+    try:
+      os.write(self.wfd, "x")
+    except OSError as e:
+      if e.errno != errno.EAGAIN:
+        raise  # A full pipe will wake the loop anyway
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    try:
+      self.recv(4096)
+    except OSError:
+      pass
+
+
+class Loop(object):
+  """
+  A small single-threaded event loop: asyncore channels registered in
+  self.map plus timers scheduled with call_later, and calls handed over
+  from other threads with call_soon_threadsafe.
+
+  """
+  def __init__(self):
+    self.map = {}
+    self.timers = []
+    self.counter = itertools.count()
+    self.calls = collections.deque()
+    self.waker = Waker(self)
+
+  def call_soon_threadsafe(self, func, *args):
+    """Run func(*args) on the loop as soon as possible, from any thread."""
+    self.calls.append((func, args))
+    self.waker.wake()
+
+  def call_later(self, delay, func, *args):
+    """
+    Run func(*args) on the loop after delay seconds.
+    Returns a handle that can be passed to cancel().
+
+    """
+    timer = [time.time() + delay, next(self.counter), func, args]
+    heapq.heappush(self.timers, timer)
+    return timer
+
+  @staticmethod
+  def cancel(timer):
+    timer[2] = None
+
+  def run_timers(self):
+    """
+    Run the calls from other threads and every timer that is due, and
+    return the time until the next timer.
+
+    """
+    for ix in range(len(self.calls)):
+      func, args = self.calls.popleft()
+      func(*args)
+    now = time.time()
+    while self.timers and self.timers[0][0] <= now:
+      deadline, seq, func, args = heapq.heappop(self.timers)
+      if func is not None:
+        func(*args)
+    if self.timers:
+      return max(0, self.timers[0][0] - now)
+    return None
+
+  def run(self):
+    """Run until there are no channels (besides the waker), timers or calls left."""
+    while True:
+      timeout = self.run_timers()
+      if len(self.map) <= 1 and not self.timers and not self.calls:
+        return  # Checked after the timers, which may have been the last
+      if self.calls:
+        timeout = 0  # Handed over while the timers ran
+      if self.map:
+        asyncore.loop(timeout=30.0 if timeout is None else timeout,
+                      use_poll=True, map=self.map, count=1)
+      elif timeout:
+        time.sleep(timeout)
+
+
+class EventHandler(inotifyhandler.EventHandler):
+  """
+  Event Handler implementation that reads inotify events from an event
+  loop instead of a blocking notifier.
+
+  Actions that provide a trigger_async static method are started on the
+  loop thread and finish in the background, so any number of them can be
+  waiting at once without a thread each. trigger_async is called with
+  the loop, a callback and the usual action arguments; it must not block,
+  and it calls the callback with None or the error once the action is
+  done. Other actions are run on the worker pool as usual. Either way, a
+  file's actions run one after another, in config order.
+
+  """
+  def __init__(self, settingsfile):
+    inotifyhandler.EventHandler.__init__(self, settingsfile)
+    self.loop = Loop()
+
+  def dispatch(self, jobs, pathname, received=None):
+    """
+    Run a file's actions in order. If none of them can be started on the
+    loop, they run on the worker pool as a single job; otherwise each is
+    started once the one before it has finished, on the loop if it has a
+    trigger_async and on the worker pool if not. Journaled actions start
+    once their records are on disk.
+
+    """
+    if not any(self.async_trigger(job[0]) for job in jobs):
+      inotifyhandler.EventHandler.dispatch(self, jobs, pathname, received)
+      return
+    if self.journal is None:
+      self.run_next(jobs, 0, pathname, received)
+      return
+    # Start once the journal has the records on disk, without waiting for
+    # it on the loop, so other files can be journaled in the same fsync.
+    self.journal.when_durable(jobs[-1][2], lambda:
+      self.loop.call_soon_threadsafe(self.run_next, jobs, 0, pathname,
+                                     received))
+
+  def run_next(self, jobs, ix, pathname, received):
+    """Start the ix'th of a file's actions. Runs on the loop thread."""
+    if ix >= len(jobs):
+      return
+    action, rule_name, ticket = jobs[ix]
+    trigger_async = self.async_trigger(action)
+    if trigger_async is None:
+      def run():
+        try:
+          self.run_action(action, pathname, rule_name, ticket, received)
+        finally:
+          self.loop.call_soon_threadsafe(self.run_next, jobs, ix + 1,
+                                         pathname, received)
+      self.executor.submit(run)
+      return
+    self.start_action(trigger_async, action, pathname, rule_name, ticket,
+                      received, lambda: self.run_next(jobs, ix + 1, pathname,
+                                                      received))
+
+  def run_settled(self):
+    """Run the periodic work and check again after another tick."""
+    self.on_tick()
+    self.loop.call_later(self.tick, self.run_settled)
+
+  def start(self):
+    wm = pyinotify.WatchManager()
+    notifier = pyinotify.AsyncNotifier(wm, self, channel_map=self.loop.map)
+    self.add_watches(wm)
+    self.watch_settings()
+    if self.metrics is not None:
+      self.metrics.start()
+    if self.profiler is not None:
+      signal.signal(signal.SIGUSR1, self.profiler.start)
+    signal.signal(signal.SIGHUP, self.hangup)
+    if self.journal is not None:
+      self.replay_journal()
+    if self.state is not None:
+      self.start_catch_up()
+    self.loop.call_later(self.tick, self.run_settled)
+    try:
+      self.loop.run()
+    finally:
+      self.shutdown()
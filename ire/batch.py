@@ -0,0 +1,121 @@
+import os
+import sys
+import time
+import threading
+import multiprocessing
+import multiprocessing.util
+
+import ire.scan as scan
+import ire.eventhandler as eventhandler
+
+_handler = None  # The EventHandler of the current (worker) process
+_location = None
+
+
+def _init(configfile, location, rules):
+  """Load the config in a worker process."""
+  global _handler, _location
+  _handler = eventhandler.EventHandler(configfile)
+  _handler.set_watches([{
+    "location": location,
+    "rules": rules
+  }])
+  _location = location
+  # Pool workers exit without running atexit handlers, but do run these
+  multiprocessing.util.Finalize(_handler, _handler.shutdown, exitpriority=10)
+
+
+def _process(item):
+  """
+  Match one file and run its actions.
+  Returns (rules matched, actions run, actions failed).
+
+  """
+  dirpath, filename = item
+  pathname = os.path.join(dirpath, filename)
+  rules = _handler.matches(_location, filename, pathname)
+  run = failed = 0
+  for rule in rules:
+    for action in rule.actions:
+      run += 1
+      if not _handler.run_action(action, pathname, rule.name):
+        failed += 1
+  return len(rules), run, failed
+
+
+class Batch(object):
+  """
+  Runs a set of rules over every file in a directory (ire.py -r).
+
+  The directory is walked lazily and files are handed to `jobs` worker
+  processes (each with its own copy of the config) to be matched and
+  have their actions run. Only a bounded number of files are queued at a
+  time, so memory stays flat no matter how many files there are.
+  Progress is written to stderr every `progress` seconds.
+
+  """
+  chunksize = 64
+
+  def __init__(self, configfile, location, rules, jobs=1, recursive=False,
+                progress=5.0):
+    self.configfile = configfile
+    self.location = os.path.normpath(os.path.expanduser(location))
+    self.rules = rules
+    self.jobs = jobs
+    self.recursive = recursive
+    self.progress = progress
+    self.files = self.matched = self.actions = self.failed = 0
+
+  def walk(self):
+    """Yield (dirpath, filename) for each file (not directory) to process."""
+    return scan.files(self.location, recursive=self.recursive)
+
+  def run(self):
+    """Process every file, then print and return a summary."""
+    start = last = time.time()
+    for matched, run, failed in self.results():
+      self.files += 1
+      self.matched += bool(matched)
+      self.actions += run
+      self.failed += failed
+      if self.progress and time.time() - last >= self.progress:
+        last = time.time()
+        sys.stderr.write(self.status(last - start) + "\n")
+    summary = self.status(time.time() - start)
+    sys.stderr.write("Done. " + summary + "\n")
+    return summary
+
+  def results(self):
+    if self.jobs <= 1:
+      _init(self.configfile, self.location, self.rules)
+      for item in self.walk():
+        yield _process(item)
+      _handler.shutdown()
+      return
+
+    # The pool reads the walk from its own thread; the semaphore keeps it
+    # from getting more than a few chunks ahead of the results.
+    window = threading.Semaphore(self.jobs * self.chunksize * 4)
+    def feed():
+      for item in self.walk():
+        window.acquire()
+        yield item
+
+    pool = multiprocessing.Pool(self.jobs, _init,
+                                (self.configfile, self.location, self.rules))
+    try:
+      for result in pool.imap_unordered(_process, feed(), self.chunksize):
+        window.release()
+        yield result
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+
+  def status(self, elapsed):
+    rate = self.files / elapsed if elapsed else 0
+    return ("{0} files in {1:.1f}s ({2:.0f}/s), {3} matched, {4} actions run, "
+            "{5} failed.".format(self.files, elapsed, rate, self.matched,
+                                self.actions, self.failed))
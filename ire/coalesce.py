@@ -0,0 +1,64 @@
+import time
+import heapq
+
+
+class Coalescer(object):
+  """
+  Merges repeated events for the same key (usually a file path) and
+  dispatches them once the key has been quiet for `window` seconds.
+
+  Pending keys live in a dict mapping key -> (deadline, args) and their
+  deadlines in a heap. A newer event for a key pushes a new deadline
+  instead of searching the heap; stale heap entries are skipped when they
+  come due. Adding or touching a key is O(log n), so hundreds of thousands
+  of pending paths are cheap.
+
+  The coalescer has no thread of its own: the watcher calls run_due()
+  from its event loop, so dispatch happens on the same thread as before.
+  A window of 0 dispatches every event immediately.
+
+  """
+  def __init__(self, window, dispatch):
+    self.window = window
+    self.dispatch = dispatch
+    self.pending = {}
+    self.heap = []
+
+  def __len__(self):
+    return len(self.pending)
+
+  def add(self, key, *args):
+    """Schedule dispatch(*args), replacing any pending dispatch for key."""
+    if self.window <= 0:
+      self.dispatch(*args)
+      return
+    deadline = time.time() + self.window
+    self.pending[key] = (deadline, args)
+    heapq.heappush(self.heap, (deadline, key))
+
+  def touch(self, key):
+    """Restart the quiet window of a key, if it is pending."""
+    entry = self.pending.get(key)
+    if entry is not None:
+      self.add(key, *entry[1])
+
+  def run_due(self, now=None):
+    """Dispatch every key whose window has passed."""
+    if now is None:
+      now = time.time()
+    heap = self.heap
+    pending = self.pending
+    while heap and heap[0][0] <= now:
+      deadline, key = heapq.heappop(heap)
+      entry = pending.get(key)
+      if entry is not None and entry[0] == deadline:
+        del pending[key]
+        self.dispatch(*entry[1])
+
+  def flush(self):
+    """Dispatch everything that is pending right away."""
+    pending = sorted(self.pending.values())
+    self.pending = {}
+    self.heap = []
+    for deadline, args in pending:
+      self.dispatch(*args)
@@ -1,10 +1,11 @@
-import re
 import json
+import time
 import signal
 import os.path
-import threading
 
 import ire.actions as action_module
+import ire.executor as executor_module
+import ire.matcher as matcher_module
 import ire.patterns as pattern_module
 
 
@@ -79,122 +80,486 @@ class Rule(object):
                                   self.actions)
 
 
+class RuleSet(object):
+  """
+  A compiled configuration: the rules, the match engine and matchers
+  compiled from them, the watched locations and the index of the rules
+  enabled in each location.
+  A RuleSet is not changed once it is built. Loading a config builds a
+  new one off to the side and publishes it with a single assignment to
+  EventHandler.ruleset, so readers take the reference once and use it
+  without locking.
+
+  """
+  def __init__(self, rules, engine, matchers, watches):
+    self.rules = rules
+    self.engine = engine
+    self.matchers = matchers
+    self.watches = watches
+    self.rule_index = self.index_rules(matchers, watches)
+
+  def with_watches(self, watches):
+    """Return a RuleSet with the same rules for a different set of watches."""
+    return RuleSet(self.rules, self.engine, self.matchers, watches)
+
+  @staticmethod
+  def index_rules(matchers, watches):
+    """
+    Build a dict mapping each watched location to the compiled rules
+    enabled there, in config order. Locations are keyed by their real path
+    and also by the expanded path from the config, so that lookups for the
+    paths we watch directly don't have to touch the filesystem.
+
+    """
+    enabled = {}
+    for watch in watches:
+      location = os.path.normpath(os.path.expanduser(watch["location"]))
+      for key in (location, os.path.realpath(location)):
+        enabled.setdefault(key, set()).update(watch["rules"])
+    return dict((key, [m for m in matchers if m[0].name in names])
+                for key, names in enabled.items())
+
+
+class Template(object):
+  """
+  An action argument parsed into literal text and substitutions (eg. %s),
+  so that filling it in for a file is a single join. codes is the set of
+  known substitution codes; a marker followed by anything else is kept
+  as it is.
+
+  """
+  __slots__ = ("chunks", "slots")
+
+  def __init__(self, text, marker, codes):
+    self.chunks = []
+    self.slots = []  # (index in chunks, code)
+    longest = max(len(code) for code in codes) if codes else 0
+    literal = []
+    pos = 0
+    while True:
+      ix = text.find(marker, pos)
+      if ix < 0:
+        literal.append(text[pos:])
+        break
+      literal.append(text[pos:ix])
+      start = ix + len(marker)
+      for size in range(min(longest, len(text) - start), 0, -1):
+        code = text[start:start + size]
+        if code in codes:
+          self.chunks.append("".join(literal))
+          self.slots.append((len(self.chunks), code))
+          self.chunks.append(None)
+          literal = []
+          pos = start + size
+          break
+      else:
+        literal.append(marker)
+        pos = start
+    self.chunks.append("".join(literal))
+
+  def render(self, values):
+    """Fill in the template from a mapping of substitution code to text."""
+    if not self.slots:
+      return self.chunks[0]
+    chunks = list(self.chunks)
+    for ix, code in self.slots:
+      chunks[ix] = values[code]
+    return "".join(chunks)
+
+
+class Substitutions(dict):
+  """
+  The substitution values for one file, each computed the first time a
+  template asks for it.
+
+  """
+  __slots__ = ("pathname", "funcs")
+
+  def __init__(self, pathname, funcs):
+    dict.__init__(self)
+    self.pathname = pathname
+    self.funcs = funcs
+
+  def __missing__(self, code):
+    value = self[code] = self.funcs[code](self.pathname)
+    return value
+
+
+def _mtime(pathname):
+  try:
+    return time.strftime("%Y%m%dT%H%M%S",
+                         time.localtime(os.path.getmtime(pathname)))
+  except OSError:
+    return ""
+
+
 class EventHandler(object):
+  pattern_conditions = {"AND": all, "OR": any}
+  journal = None
+  metrics = None
+  tracer = None
+  loop = None  # The event loop trigger_async is given, if there is one
   sub_marker = "%"
+  # (code, description, function of the full path returning the text)
   subs = [
     ("s", "Insert the full filename and path.", lambda x: x),
     ("f", "Insert just the filename.", lambda x: os.path.basename(x)),
+    ("n", "Insert the filename without its extension.",
+      lambda x: os.path.splitext(os.path.basename(x))[0]),
+    ("e", "Insert the file's extension, without the dot.",
+      lambda x: os.path.splitext(x)[1][1:]),
+    ("d", "Insert the path of the directory containing the file.",
+      lambda x: os.path.dirname(x)),
+    ("m", "Insert the file's modification time (YYYYMMDDTHHMMSS).", _mtime),
   ]
 
   def __init__(self, settingsfile):
     self.settingsfile = settingsfile
-    self.rules_lock = threading.Lock()
-    self.watches_lock = threading.Lock()
-    self.load_config(settingsfile)
-    
+    self.reload_requested = False
+    self.sub_funcs = dict((sub[0], sub[2]) for sub in self.subs)
+    self.templates = {}
+
     self.actions = dict(zip(action_module.action_list,
       [getattr(action_module, action) for action in
                                           action_module.action_list]))
     self.patterns = dict(zip(pattern_module.pattern_list,
       [getattr(pattern_module, pattern) for pattern in
                                             pattern_module.pattern_list]))
-    
+
+    self.load_config(settingsfile)
+    self.executor = executor_module.Executor(
+      workers=self.options.get("workers", 4),
+      queue_size=self.options.get("queue_size", 1000))
   
+  rules = property(lambda self: self.ruleset.rules)
+  engine = property(lambda self: self.ruleset.engine)
+  matchers = property(lambda self: self.ruleset.matchers)
+  watches = property(lambda self: self.ruleset.watches)
+  rule_index = property(lambda self: self.ruleset.rule_index)
+
   def load_config(self, settingsfile):
-    """Load configuration from a filename."""
+    """
+    Load configuration from a filename. The rules are compiled before
+    anything is replaced, and replaced all at once.
+
+    """
     try:
       with open(settingsfile, 'r') as f:
         settings = json.load(f, cls=SettingsDecoder)
-      with locked(self.rules_lock):
-        self.rules = settings["rules"]
-      with locked(self.watches_lock):
-        self.watches = settings["watches"]
+      # Before compiling, since patterns may be configured at compile time
+      for style, options in settings.get("pattern_options", {}).items():
+        configure = getattr(self.patterns.get(style), "configure", None)
+        if configure is not None:
+          configure(**options)
+      engine = matcher_module.MatchEngine()
+      matchers = []
+      for rule in settings["rules"]:
+        try:
+          matchers.append((rule, self.compile_rule(rule, engine)))
+        except pattern_module.PatternError as e:
+          print "Invalid rule with name {0}: {1}".format(rule.name, e)
+      for rule, matcher in matchers:
+        for action in rule.actions:
+          for text in action["args"].values():
+            if isinstance(text, basestring):
+              self.template(text)
+      # Also before the swap, so bad options leave the old config in place
+      for action_type, options in settings.get("action_options", {}).items():
+        configure = getattr(self.actions.get(action_type), "configure", None)
+        if configure is not None:
+          configure(**options)
+      self.ruleset = RuleSet(settings["rules"], engine, matchers,
+                             settings["watches"])
+      self.options = settings.get("options", {})
     except IOError as e:
       raise Exception("Could not load config.")
 
+  def set_watches(self, watches):
+    """Replace the watched locations and rebuild the rule index."""
+    self.ruleset = self.ruleset.with_watches(watches)
+
+  def reload(self):
+    """
+    Load the settings file again, keeping the current configuration if
+    the file can't be loaded. Returns the RuleSet that was replaced, or
+    None if the reload failed.
+
+    """
+    old = self.ruleset
+    try:
+      self.load_config(self.settingsfile)
+    except Exception as e:
+      print "Could not reload config {0}: {1}".format(self.settingsfile, e)
+      return None
+    print "Reloaded config {0}".format(self.settingsfile)
+    return old
+
+  def check_reload(self):
+    """Reload the config if a reload has been requested."""
+    if self.reload_requested:
+      self.reload_requested = False
+      self.reload()
+
   def config_reset_handler(self, signum, frame):
-    """Signal handler to reload configuration settings from a file."""
-    self.load_config(self.settingsfile)
+    """
+    Signal handler to reload configuration settings from a file.
+    The reload itself happens on the next check_reload, between events.
 
-  def matches(self, path, filename):
+    """
+    self.reload_requested = True
+
+  def compile_pattern(self, pattern, engine):
+    """
+    Resolve the pattern class for an entry in a rule's pattern list and
+    register it with the match engine, returning its pattern id.
+
+    """
+    style = pattern["style"]
+    if style not in self.patterns:
+      raise pattern_module.UnknownPatternStyleError(style)
+    return engine.add(self.patterns[style], pattern["pattern"])
+
+  def compile_rule(self, rule, engine):
+    """
+    Compile a rule into a single callable that accepts the Hits from a
+    MatchEngine scan and returns True if the rule's patterns match.
+    Raises a PatternError if the rule cannot be compiled.
+
+    """
+    func = self.pattern_conditions.get(rule.pattern_condition.upper())
+    if func is None:
+      raise pattern_module.PatternError(
+        "Unknown pattern condition '{0}'".format(rule.pattern_condition))
+    pids = tuple(self.compile_pattern(pat, engine)
+                  for pat in rule.pattern_list)
+    return engine.rule(func, pids)
+
+  def matches(self, path, filename, pathname=None):
     """
     Return a list of rules that match the given filename.
 
     Keyword arguments:
     path -- The file path that determines valid rules.
     filename -- The filename to match against valid rules.
+    pathname -- The full path of the file, if it isn't in path itself
+                (eg. in a subdirectory of a recursive watch).
     
     """
+    if pathname is None:
+      pathname = os.path.join(path, filename)
     matched = []
-    
-    def get_pattern_class(pattern):
-      """
-      Each entry in the pattern list contains the
-      style and the pattern to match.
-
-      """
-      style = pattern["style"]
-      if style not in self.patterns:
-        raise pattern_module.UnknownPatternStyleError(style)
-      return self.patterns[style].match(pattern["pattern"], filename)
-    
-    with locked(self.rules_lock):
-      for rule in self.rules:
-        func = None
-        if rule.pattern_condition.upper() == "AND":
-          func = all
-        elif rule.pattern_condition.upper() == "OR":
-          func = any
-        try:
-          if func and func(get_pattern_class(pat) for pat in rule.pattern_list):
-            with locked(self.watches_lock):
-              for watch in self.watches:
-                if(path == os.path.expanduser(watch["location"]) and
-                    rule.name in watch["rules"]):
-                  matched.append(rule)
-        except pattern_module.PatternError as e:
-          print e
+    tracer = self.tracer
+    if tracer is not None:
+      if tracer.sampled(pathname):
+        start = time.time()
+      else:
+        tracer = None
+    ruleset = self.ruleset
+    enabled = ruleset.rule_index.get(path)
+    if enabled is None:
+      enabled = ruleset.rule_index.get(os.path.realpath(path), ())
+    hits = ruleset.engine.scan(filename, pathname, tracer,
+                               self.metrics is not None)
+    for rule, matcher in enabled:
+      try:
+        if matcher(hits):
+          matched.append(rule)
+      except pattern_module.PatternError as e:
+        print e
+    if tracer is not None:
+      tracer.span("matches", start, args={
+        "path": pathname, "rules": [rule.name for rule in matched]})
     return matched
 
-  def do_actions(self, rules, pathname):
-    """Combine the actions for each rule and execute them."""
-    actions = []
-    with locked(self.rules_lock):
-      for rule in rules:
-        actions.extend(rule.actions)
+  def do_actions(self, rules, pathname, received=None):
+    """
+    Combine the actions for each rule and execute them, one after another
+    in config order. received is the time the event for the file arrived,
+    if it came from an event.
 
-    for action in actions:
+    """
+    jobs = []
+    for rule in rules:
+      if self.metrics is not None:
+        self.metrics.rule_matches.inc(rule.name)
+      for action in rule.actions:
+        ticket = None
+        if self.journal is not None:
+          ticket = self.journal.begin(pathname, rule.name, action)
+        jobs.append((action, rule.name, ticket))
+    if jobs:
+      self.dispatch(jobs, pathname, received)
+
+  def dispatch(self, jobs, pathname, received=None):
+    """
+    Hand a file's actions, a list of (action, rule name, journal ticket),
+    over to be run as a single job, so they run in order.
+
+    """
+    self.executor.submit(self.run_actions, jobs, pathname, received)
+
+  def async_trigger(self, action):
+    """Return the trigger_async of an action's type, or None."""
+    return getattr(self.actions.get(action["type"]), "trigger_async", None)
+
+  def run_actions(self, jobs, pathname, received=None, start=0):
+    """
+    Run a file's actions one after another, from the start'th on. An
+    action with a trigger_async finishes in the background, and the
+    actions after it are queued again once it is done, rather than
+    holding up the worker meanwhile.
+
+    """
+    for ix in range(start, len(jobs)):
+      action, rule_name, ticket = jobs[ix]
+      trigger_async = self.async_trigger(action)
+      if trigger_async is None:
+        self.run_action(action, pathname, rule_name, ticket, received)
+        continue
+      def then(ix=ix):
+        if ix + 1 < len(jobs):
+          self.executor.submit(self.run_actions, jobs, pathname, received,
+                               ix + 1)
+      self.start_action(trigger_async, action, pathname, rule_name, ticket,
+                        received, then)
+      return
+
+  def start_action(self, trigger_async, action, pathname, rule_name=None,
+                   ticket=None, received=None, then=None):
+    """
+    Substitute the action's arguments and start it with trigger_async,
+    which is passed self.loop (None unless the handler has an event
+    loop). Once the action is done, it is marked done in the journal and
+    then() is called.
+
+    """
+    if ticket is not None:
+      self.journal.wait(ticket)
+    started = time.time()
+    args = self.sub_args(action["args"], pathname)
+    args["_rule"] = rule_name
+    substituted = time.time()
+
+    def done(error=None):
+      if ticket is not None:
+        self.journal.done(ticket)
+      if self.metrics is not None:
+        self.metrics.action_finished(action["type"], started, error is None,
+                                     received)
+      if self.tracer is not None:
+        self.trace_action(action["type"], rule_name, pathname, started,
+                          substituted, error is None)
+      if error is not None:
+        print ("Exception encountered running action "
+              "{0}: {1}".format(action["type"], error))
+      if then is not None:
+        then()
+
+    try:
+      trigger_async(self.loop, done, **args)
+    except Exception as e:
+      done(e)
+
+  def run_action(self, action, pathname, rule_name=None, ticket=None,
+                 received=None):
+    """
+    Substitute the action's arguments and execute it. If the action was
+    journaled, it only runs once its journal entry is on disk, and is
+    marked done afterwards.
+
+    """
+    if ticket is not None:
+      self.journal.wait(ticket)
+    started = time.time()
+    substituted = None
+    ok = False
+    try:
       args = self.sub_args(action["args"], pathname)
-      self.exe(action["type"], args)
+      substituted = time.time()
+      args["_rule"] = rule_name  # name of the rule that fired the action
+      ok = self.exe(action["type"], args)
+      return ok
+    finally:
+      if ticket is not None:
+        self.journal.done(ticket)
+      if self.metrics is not None:
+        self.metrics.action_finished(action["type"], started, ok, received)
+      if self.tracer is not None and substituted is not None:
+        self.trace_action(action["type"], rule_name, pathname, started,
+                          substituted, ok)
+
+  def trace_action(self, action_type, rule_name, pathname, started,
+                   substituted, ok):
+    """Record the spans for an action that has just finished, if sampled."""
+    if self.tracer.sampled(pathname):
+      self.tracer.span("sub_args", started, substituted)
+      self.tracer.span("exe " + action_type, substituted,
+                       args={"rule": rule_name, "ok": ok})
   
+  def template(self, text):
+    """Return the compiled Template for an argument, compiling it once."""
+    template = self.templates.get(text)
+    if template is None:
+      template = Template(text, self.sub_marker,
+                          set(sub[0] for sub in self.subs))
+      self.templates[text] = template
+    return template
+
   def sub_args(self, out, pathname):
     """
     Substitute text for shorthand directives (eg. %s) in all arguments.
     Full list of subs can be found in EventHandler.subs
 
     """
-
-    to_sub = out.copy()
-    for key in to_sub:
-      for sub in self.subs:
-        to_sub[key] = re.sub(self.sub_marker + sub[0],
-                              sub[2](pathname), to_sub[key])
-    to_sub.update({ "_filename": os.path.basename(pathname),  # filename
-                  "_directory": os.path.dirname(pathname),  # just the directory
+    values = Substitutions(pathname, self.sub_funcs)
+    directory, filename = os.path.split(pathname)
+    values.update(s=pathname, f=filename, d=directory)  # Always needed
+    to_sub = {}
+    for key, text in out.items():
+      if isinstance(text, basestring):
+        text = self.template(text).render(values)
+      to_sub[key] = text
+    to_sub.update({ "_filename": filename,  # filename
+                  "_directory": directory,  # just the directory
                   "_path": pathname})  # full path (dir+filename)
     return to_sub
     
   def exe(self, action_type, kwdict):
-    """Execute the action with argument dictionary."""
-    # TODO Spin off into threads? Might be helpful for long-running actions
+    """
+    Execute the action with argument dictionary.
+    Returns True if the action ran without raising an exception.
+
+    """
     if action_type not in self.actions:
       raise KeyError("Unknown action type specified.")
     try:
       self.actions[action_type].trigger(**kwdict)
+      return True
     except Exception as e:  # Don't want to crash everything... right?
       print ("Exception encountered running action "
             "{0}: {1}".format(action_type, e))
+      return False
   
+  def hangup(self, signum=None, frame=None):
+    """
+    Handle a SIGHUP: actions reopen the files they keep open and the
+    config is reloaded.
+
+    """
+    for action in self.actions.values():
+      reopen = getattr(action, "reopen", None)
+      if reopen is not None:
+        reopen()
+    self.config_reset_handler(signum, frame)
+
+  def shutdown(self):
+    """Wait for queued actions to finish, then let actions clean up."""
+    self.executor.shutdown()
+    for action in self.actions.values():
+      shutdown = getattr(action, "shutdown", None)
+      if shutdown is not None:
+        shutdown()
+
   def start(self):
     """
     Watch the filesystem for changes in watched directories, matching and
@@ -0,0 +1,63 @@
+import Queue
+import threading
+
+
+class Executor(object):
+  """
+  Runs jobs (usually actions) on a fixed pool of worker threads.
+
+  Jobs wait in a bounded queue. When the queue is full, submit() blocks
+  until a worker frees up a slot, so a flood of events slows down intake
+  instead of growing memory without limit. With zero workers, jobs are
+  run immediately on the calling thread.
+
+  """
+  def __init__(self, workers=4, queue_size=1000):
+    self.queue = Queue.Queue(maxsize=queue_size)
+    self.threads = []
+    for ix in range(workers):
+      thread = threading.Thread(target=self._work,
+                                name="ire-worker-{0}".format(ix))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def submit(self, func, *args):
+    """Queue func(*args) to be run on a worker thread."""
+    if not self.threads:
+      func(*args)
+      return
+    # A put() without a timeout can't be interrupted by signals in
+    # Python 2, so poll instead to keep Ctrl-C working under backpressure.
+    while True:
+      try:
+        self.queue.put((func, args), timeout=0.5)
+        return
+      except Queue.Full:
+        pass
+
+  def pending(self):
+    """Return the number of jobs waiting for a worker."""
+    return self.queue.qsize()
+
+  def _work(self):
+    while True:
+      job = self.queue.get()
+      try:
+        if job is None:
+          return
+        func, args = job
+        func(*args)
+      except Exception as e:
+        print "Exception encountered in worker: {0}".format(e)
+      finally:
+        self.queue.task_done()
+
+  def shutdown(self, wait=True):
+    """Stop the workers once every queued job has run."""
+    for thread in self.threads:
+      self.queue.put(None)
+    if wait:
+      for thread in self.threads:
+        thread.join()
+    self.threads = []
@@ -0,0 +1,55 @@
+import time
+import collections
+
+
+class ExpiringSet(object):
+  """
+  A set whose members expire `ttl` seconds after they were last added and
+  which never holds more than `maxsize` members; when full, the members
+  closest to expiring are evicted first.
+
+  Members are kept in an OrderedDict in order of expiry (every member gets
+  the same ttl, so re-adding a member just moves it to the end). Expired
+  members are dropped from the front as the set is used, so each operation
+  is amortized O(1).
+
+  """
+  def __init__(self, ttl, maxsize):
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self.members = collections.OrderedDict()
+    self.expired = 0  # Members dropped because their ttl ran out
+    self.evicted = 0  # Members dropped to stay under maxsize
+
+  def __len__(self):
+    self.expire()
+    return len(self.members)
+
+  def __contains__(self, key):
+    self.expire()
+    return key in self.members
+
+  def add(self, key):
+    self.expire()
+    self.members.pop(key, None)
+    self.members[key] = time.time() + self.ttl
+    while len(self.members) > self.maxsize:
+      self.members.popitem(last=False)
+      self.evicted += 1
+
+  def pop(self, key):
+    """Remove a member. Returns True if it was in the set."""
+    self.expire()
+    return self.members.pop(key, None) is not None
+
+  def expire(self, now=None):
+    """Drop every member whose ttl has run out."""
+    if now is None:
+      now = time.time()
+    members = self.members
+    while members:
+      key, deadline = next(iter(members.iteritems()))
+      if deadline > now:
+        break
+      del members[key]
+      self.expired += 1
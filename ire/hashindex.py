@@ -0,0 +1,244 @@
+import os
+import stat
+import sqlite3
+import hashlib
+import threading
+
+import ire.scan as scan
+
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
+
+
+class HashIndex(object):
+  """
+  An on-disk index of the files below one or more directories ("roots"),
+  used to find files with identical contents.
+
+  Files are indexed by size first; a content hash is only computed when
+  another file of the same size turns up, so files with a unique size are
+  never read. Hashes are stored with the (dev, inode, mtime) they were
+  computed for and reused while those stay the same.
+  Contents are hashed with large buffered reads.
+
+  refresh() keeps a root current while the index is in use: the first
+  call indexes it and starts watching it with inotify, later calls only
+  apply the changes reported since. Without inotify, or if the root
+  can't be watched, every call walks the root again.
+
+  """
+  read_size = 1 << 20
+
+  def __init__(self, filename):
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    # The index can always be rebuilt, so trade durability for cheap commits
+    self.db.execute("PRAGMA journal_mode=WAL")
+    self.db.execute("PRAGMA synchronous=NORMAL")
+    self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                    "root TEXT, path TEXT, dev INTEGER, ino INTEGER, "
+                    "mtime REAL, size INTEGER, hash TEXT, "
+                    "PRIMARY KEY (root, path))")
+    self.db.execute("CREATE INDEX IF NOT EXISTS files_size "
+                    "ON files (root, size)")
+    self.db.execute("CREATE INDEX IF NOT EXISTS files_inode "
+                    "ON files (dev, ino)")
+    self.db.commit()
+    self.watchers = {}  # root -> RootWatcher, or None if not watched
+
+  def refresh(self, root):
+    """Bring the index for a root up to date before looking files up."""
+    if root not in self.watchers:
+      watcher = None
+      if pyinotify is not None:
+        # Watch before indexing, so nothing added meanwhile is missed
+        watcher = RootWatcher(self, root)
+        if not watcher.ok:
+          watcher.close()
+          watcher = None
+      self.watchers[root] = watcher
+      self.update(root)
+    elif self.watchers[root] is None:
+      self.update(root)
+    else:
+      self.watchers[root].process()
+
+  def update(self, root, top=None):
+    """
+    Bring the index for a root (or the directory top inside it) up to
+    date with the filesystem. Only files are stat'ed; nothing is hashed.
+
+    """
+    if top is None:
+      top = root
+    prefix = os.path.join(top, '')
+    with self.lock:
+      known = dict((path, (dev, ino, mtime, size)) for path, dev, ino, mtime,
+        size in self.db.execute("SELECT path, dev, ino, mtime, size FROM "
+                                "files WHERE root = ? AND substr(path, 1, ?) "
+                                "= ?", (root, len(prefix), prefix)))
+      changed = []
+      for dirpath, filename in scan.files(top, recursive=True):
+        path = os.path.join(dirpath, filename)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        key = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+        if known.pop(path, None) != key:
+          changed.append((root, path) + key)
+      self.db.executemany("INSERT OR REPLACE INTO files VALUES "
+                          "(?, ?, ?, ?, ?, ?, NULL)", changed)
+      self.db.executemany("DELETE FROM files WHERE root = ? AND path = ?",
+                          [(root, path) for path in known])
+      self.db.commit()
+
+  def add(self, root, path):
+    """Index a file that was added or changed below a root."""
+    try:
+      st = os.stat(path)
+    except OSError:
+      self.forget(root, path)
+      return
+    if not stat.S_ISREG(st.st_mode):
+      return
+    key = (st.st_dev, st.st_ino, st.st_mtime, st.st_size)
+    with self.lock:
+      row = self.db.execute("SELECT dev, ino, mtime, size FROM files WHERE "
+                            "root = ? AND path = ?", (root, path)).fetchone()
+      if row is None or tuple(row) != key:
+        self.db.execute("INSERT OR REPLACE INTO files VALUES "
+                        "(?, ?, ?, ?, ?, ?, NULL)", (root, path) + key)
+        self.db.commit()
+
+  def forget(self, root, path):
+    """Remove a file, or a directory and everything in it, from a root."""
+    prefix = os.path.join(path, '')
+    with self.lock:
+      self.db.execute("DELETE FROM files WHERE root = ? AND (path = ? OR "
+                      "substr(path, 1, ?) = ?)", (root, path, len(prefix),
+                                                 prefix))
+      self.db.commit()
+
+  def close(self):
+    for watcher in self.watchers.values():
+      if watcher is not None:
+        watcher.close()
+    self.watchers = {}
+    with self.lock:
+      self.db.close()
+
+  def digest(self, path, st):
+    """Return the content hash of a file, reusing a stored one if valid."""
+    with self.lock:
+      row = self.db.execute("SELECT hash FROM files WHERE dev = ? AND "
+                            "ino = ? AND mtime = ? AND size = ? AND hash IS "
+                            "NOT NULL", (st.st_dev, st.st_ino, st.st_mtime,
+                                          st.st_size)).fetchone()
+    if row is not None:
+      return row[0]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(self.read_size), ''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+  def duplicate(self, root, path, st):
+    """
+    Return True if a file other than path with the same contents is
+    indexed under root. path is added to the index for root if it is
+    inside it.
+
+    """
+    with self.lock:
+      candidates = self.db.execute("SELECT path, dev, ino, mtime, hash FROM "
+                                   "files WHERE root = ? AND size = ? AND "
+                                   "path != ?", (root, st.st_size, path)
+                                  ).fetchall()
+    found = False
+    digest = None
+    if candidates:
+      digest = self.digest(path, st)
+      for other, dev, ino, mtime, other_digest in candidates:
+        if (dev, ino) == (st.st_dev, st.st_ino):
+          continue  # A hard link to the same file
+        if other_digest is None:
+          other_digest = self._hash_candidate(root, other)
+        if other_digest == digest:
+          found = True
+          break
+    if path.startswith(os.path.join(root, '')):
+      with self.lock:
+        self.db.execute("INSERT OR REPLACE INTO files VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?)", (root, path, st.st_dev,
+                        st.st_ino, st.st_mtime, st.st_size, digest))
+        self.db.commit()
+    return found
+
+  def _hash_candidate(self, root, path):
+    """Hash an indexed file and store the hash. Returns None if it's gone."""
+    try:
+      st = os.stat(path)
+      digest = self.digest(path, st)
+    except (IOError, OSError):
+      with self.lock:
+        self.db.execute("DELETE FROM files WHERE root = ? AND path = ?",
+                        (root, path))
+        self.db.commit()
+      return None
+    with self.lock:
+      self.db.execute("INSERT OR REPLACE INTO files VALUES "
+                      "(?, ?, ?, ?, ?, ?, ?)", (root, path, st.st_dev,
+                      st.st_ino, st.st_mtime, st.st_size, digest))
+      self.db.commit()
+    return digest
+
+
+class RootWatcher(object):
+  """
+  Applies the changes below a root reported by inotify to a HashIndex.
+  Events are read without blocking, from process().
+
+  """
+  def __init__(self, index, root):
+    self.index = index
+    self.root = root
+    self.mask = (pyinotify.IN_CREATE|pyinotify.IN_CLOSE_WRITE|
+                 pyinotify.IN_MOVED_TO|pyinotify.IN_MOVED_FROM|
+                 pyinotify.IN_DELETE)
+    self.wm = pyinotify.WatchManager()
+    self.notifier = pyinotify.Notifier(self.wm, self)
+    wds = self.wm.add_watch(root, self.mask, rec=True, auto_add=True,
+                            quiet=True)
+    self.ok = bool(wds) and all(wd >= 0 for wd in wds.values())
+
+  def process(self):
+    """Apply every event that has arrived since the last call."""
+    while self.notifier.check_events(timeout=0):
+      self.notifier.read_events()
+      self.notifier.process_events()
+
+  def __call__(self, event):
+    if event.mask & pyinotify.IN_Q_OVERFLOW:
+      self.index.update(self.root)  # Events were lost
+      return
+    path = event.pathname
+    if event.mask & (pyinotify.IN_DELETE|pyinotify.IN_MOVED_FROM):
+      if event.dir and event.mask & pyinotify.IN_MOVED_FROM:
+        wd = self.wm.get_wd(path)
+        if wd is not None:
+          self.wm.rm_watch(wd, rec=True, quiet=True)
+      self.index.forget(self.root, path)
+    elif event.dir:
+      if event.mask & pyinotify.IN_MOVED_TO:
+        self.wm.add_watch(path, self.mask, rec=True, auto_add=True,
+                          quiet=True)
+      # Files can appear in a new directory before it is watched
+      self.index.update(self.root, path)
+    else:
+      self.index.add(self.root, path)
+
+  def close(self):
+    self.notifier.stop()
@@ -1,7 +1,18 @@
 import re
+import time
+import Queue
 import os.path
+import signal
+import threading
 import pyinotify
 
+import ire.scan as scan
+import ire.coalesce as coalesce
+import ire.journal as journal
+import ire.metrics as metrics
+import ire.tracing as tracing
+import ire.expiring as expiring
+import ire.stateindex as stateindex
 import ire.eventhandler as eventhandler
 
 locked = eventhandler.locked
@@ -10,50 +21,408 @@ locked = eventhandler.locked
 
 class EventHandler(pyinotify.ProcessEvent, eventhandler.EventHandler):
   """Event Handler implementation using inotify."""
+  mask = (pyinotify.IN_CREATE|pyinotify.IN_MOVED_TO|
+          pyinotify.IN_CLOSE_NOWRITE|pyinotify.IN_CLOSE_WRITE)
+  tree_mask = mask|pyinotify.IN_MOVED_FROM  # For recursive watches
+  settings_mask = pyinotify.IN_CLOSE_WRITE|pyinotify.IN_MOVED_TO
+  reload_check = 1.0  # Seconds between checks for a config reload
+  found_limit = 10000  # Files found by catch_up waiting to be dispatched
+  wm = None
+  settings_notifier = None
+  recorder = None  # An ire.replay.Recorder to write every event to
 
   def __init__(self, settingsfile):
     pyinotify.ProcessEvent.__init__(self)
     eventhandler.EventHandler.__init__(self, settingsfile)
-    self.in_progress = set()
+    self.in_progress = expiring.ExpiringSet(
+      ttl=self.options.get("in_progress_ttl", 86400),
+      maxsize=self.options.get("in_progress_limit", 100000))
+    self.watch_roots = {}
+    if self.options.get("journal"):
+      self.journal = journal.Journal(
+        os.path.expanduser(self.options["journal"]))
+    self.state = None
+    self.catch_up_thread = None
+    if self.options.get("state_db"):
+      self.state = stateindex.StateIndex(
+        os.path.expanduser(self.options["state_db"]))
+      self.found = Queue.Queue(maxsize=self.found_limit)
+      self.stopping = threading.Event()
+    self.settle = coalesce.Coalescer(self.options.get("settle_window", 0),
+                                     self.match_exec)
+    if (self.options.get("metrics_file") or
+        self.options.get("metrics_socket")):
+      self.metrics = metrics.Metrics(
+        textfile=self.options.get("metrics_file"),
+        interval=self.options.get("metrics_interval", 15),
+        socket=self.options.get("metrics_socket"))
+      self.metrics.watch(self)
+    if self.options.get("trace_file"):
+      self.tracer = tracing.Tracer(
+        os.path.expanduser(self.options["trace_file"]),
+        sample=self.options.get("trace_sample", 100))
+    self.profiler = None
+    if self.options.get("profile_file"):
+      self.profiler = tracing.Profiler(
+        os.path.expanduser(self.options["profile_file"]),
+        seconds=self.options.get("profile_seconds", 30))
+
+  def __call__(self, event):
+    if self.recorder is not None:
+      self.recorder.record(event, self.rule_path(event.path))
+    if self.metrics is not None:
+      self.metrics.events.inc(event.maskname)
+    return pyinotify.ProcessEvent.__call__(self, event)
+
+  @property
+  def watch_limit(self):
+    """The most inotify watches this user may have (fs.inotify)."""
+    if self._watch_limit is None:
+      try:
+        with open("/proc/sys/fs/inotify/max_user_watches") as f:
+          self._watch_limit = int(f.read())
+      except (IOError, ValueError):
+        self._watch_limit = float("inf")
+    return self._watch_limit
+  _watch_limit = None
+
+  @property
+  def tick(self):
+    """How often, in seconds, the settle window and reloads are checked."""
+    if self.settle.window <= 0:
+      return self.reload_check
+    return min(self.settle.window, 0.1, self.reload_check)
+
+  def on_tick(self):
+    """Run the periodic work between batches of events."""
+    self.poll_settings()
+    self.check_reload()
+    if self.catch_up_thread is not None:
+      self.dispatch_caught_up()
+    self.settle.run_due()
     
   def process_IN_CREATE(self, event):
     """
     Start tracking when a watched file is created.
     Must be paired with process_IN_CLOSE_NOWRITE to ensure that the created
     file is fully completed (eg. after a download).
+    Every created file is tracked, since it is still empty: rules on its
+    size or contents can only be matched once it has been closed.
     
     """
-    if self.matches(event.path, os.path.basename(event.pathname)):
-      self.in_progress.add(event.wd)
+    if event.dir:
+      self.watch_new_dir(event)
+      return
+    self.in_progress.add(event.pathname)
+    self.settle.touch(event.pathname)
     
   def process_IN_CLOSE_NOWRITE(self, event):
     """
     Execute actions when a watched file is closed.
     Limited to executing on files that were created and subsequently closed,
-    to prevent execution when just opening a file.
+    to prevent execution when just opening a file. Closing a file that is
+    still settling (eg. written again after its first close) restarts its
+    quiet window. Any other file that was written is recorded again in
+    the state index, so changes made while the daemon is running (eg. by
+    an action) aren't caught up on at the next start.
 
     """
-    if event.wd in self.in_progress:
+    if self.in_progress.pop(event.pathname):
       filename = os.path.basename(event.pathname)
-      self.match_exec(event.path, filename)
-      self.in_progress.remove(event.wd)
+      self.settle.add(event.pathname, event.path, filename, time.time())
+      return
+    self.settle.touch(event.pathname)
+    if self.state is not None and event.mask & pyinotify.IN_CLOSE_WRITE:
+      self.record_state(event.pathname)
   process_IN_CLOSE_WRITE = process_IN_CLOSE_NOWRITE
   
   def process_IN_MOVED_TO(self, event):
     """Execute actions when a watched file is moved."""
+    if event.dir:
+      self.watch_new_dir(event)
     filename = os.path.basename(event.pathname)
-    self.match_exec(event.path, filename)
+    self.settle.add(event.pathname, event.path, filename, time.time())
+
+  def process_IN_MOVED_FROM(self, event):
+    """Stop watching directories moved out of a recursive watch."""
+    if event.dir:
+      self.unwatch_tree(event.pathname)
+
+  def process_IN_IGNORED(self, event):
+    """Forget a watch the kernel dropped (eg. its directory was deleted)."""
+    self.watch_roots.pop(event.path, None)
+
+  def rule_path(self, path):
+    """Return the watched location whose rules apply to a directory."""
+    return self.watch_roots.get(path, path)
 
-  def match_exec(self, path, filename):
+  def match_exec(self, path, filename, received=None):
     """Match the filename to and existing rules and execute their actions."""
-    rules = self.matches(path, filename)
-    self.do_actions(rules, os.path.join(path, filename))
+    pathname = os.path.join(path, filename)
+    if self.state is not None:
+      self.record_state(pathname)
+    rules = self.matches(self.rule_path(path), filename, pathname)
+    self.do_actions(rules, pathname, received)
+
+  def record_state(self, pathname):
+    """Record a file as handled, as it is now, in the state index."""
+    try:
+      self.state.record([os.stat(pathname)])
+    except OSError:
+      pass  # Already gone
+
+  def replay_journal(self):
+    """Run the actions left unfinished when the daemon last stopped."""
+    for record in self.journal.unfinished():
+      self.executor.submit(self.run_action, record["action"],
+                           record["path"], record["rule"], (record["id"], 0))
+
+  def start_catch_up(self):
+    """
+    Run catch_up on a thread of its own, so events are read as usual
+    while the watched locations are scanned. The files it finds are
+    dispatched from the event loop by dispatch_caught_up.
+
+    """
+    self.catch_up_thread = threading.Thread(target=self.catch_up)
+    self.catch_up_thread.daemon = True
+    self.catch_up_thread.start()
+
+  def dispatch_caught_up(self):
+    """Dispatch the files catch_up has found so far."""
+    for ix in range(self.found.qsize()):
+      try:
+        dirpath, filename = self.found.get_nowait()
+      except Queue.Empty:
+        break
+      self.dispatch_found(dirpath, filename)
+
+  def catch_up(self):
+    """
+    Find the files that appeared or changed in the watched locations
+    while the daemon wasn't running, according to the state index, and
+    queue them in self.found. The first time a location is seen, its
+    files are only recorded.
+
+    """
+    for watch in self.watches:
+      location = os.path.normpath(os.path.expanduser(watch["location"]))
+      baseline = not self.state.known_location(location)
+      batch = []
+      for dirpath, filename in scan.files(location,
+                                          recursive=watch.get("recursive")):
+        try:
+          batch.append((os.stat(os.path.join(dirpath, filename)),
+                        dirpath, filename))
+        except OSError:
+          continue
+        if len(batch) >= self.state.batch_size:
+          if not self.catch_up_batch(batch, baseline):
+            return
+          batch = []
+      if not self.catch_up_batch(batch, baseline):
+        return
+      if baseline:
+        self.state.add_location(location)
+
+  def catch_up_batch(self, batch, baseline):
+    """Handle a batch for catch_up. Returns False once shutting down."""
+    if self.stopping.is_set():
+      return False
+    if baseline:
+      self.state.record([st for st, dirpath, filename in batch])
+      return True
+    for st, dirpath, filename in self.state.unhandled(batch):
+      while True:
+        try:
+          self.found.put((dirpath, filename), timeout=0.1)
+          break
+        except Queue.Full:
+          if self.stopping.is_set():
+            return False
+    return True
+
+  def dispatch_found(self, dirpath, filename):
+    """
+    Dispatch a file found by scanning a directory rather than reported
+    by an event, recording it as well if events are being recorded.
+
+    """
+    if self.recorder is not None:
+      self.recorder.record_found(dirpath, filename, self.rule_path(dirpath))
+    self.settle.add(os.path.join(dirpath, filename), dirpath, filename)
       
+  def add_watches(self, wm):
+    """
+    Add an inotify watch for each watched location and, for recursive
+    watches, every directory below it.
+
+    """
+    self.wm = wm
+    self.watch_roots = {}  # Watched directory -> location its rules are in
+    self.recursive_roots = set()
+    for watch in self.watches:
+      self.watch_location(watch)
+
+  def watch_location(self, watch):
+    location = os.path.normpath(os.path.expanduser(watch["location"]))
+    if not watch.get("recursive"):
+      self.watch_dir(location, location, self.mask)
+    elif self.watch_dir(location, location, self.tree_mask):
+      self.recursive_roots.add(location)
+      self.watch_tree(location, location)
+
+  def unwatch_location(self, location):
+    """Remove the watches a location added (all of them, if recursive)."""
+    self.recursive_roots.discard(location)
+    for path in [p for p, root in self.watch_roots.items()
+                  if root == location]:
+      wd = self.wm.get_wd(path)
+      if wd is not None:
+        self.wm.rm_watch(wd, quiet=True)
+      del self.watch_roots[path]
+    # Still part of another location's tree
+    for root in self.recursive_roots:
+      if location.startswith(root + os.sep):
+        if self.watch_dir(location, root, self.tree_mask):
+          self.watch_tree(location, root)
+        break
+
+  def update_watches(self, old, new):
+    """
+    Change the inotify watches from the old list of watches to the new
+    one, leaving the watches on unchanged locations alone.
+
+    """
+    def key(watch):
+      return (os.path.normpath(os.path.expanduser(watch["location"])),
+              bool(watch.get("recursive")))
+    old = dict((key(watch), watch) for watch in old)
+    new = dict((key(watch), watch) for watch in new)
+    for location, recursive in set(old) - set(new):
+      self.unwatch_location(location)
+    for watch_key in set(new) - set(old):
+      self.watch_location(new[watch_key])
+
+  def reload(self):
+    """Reload the config, then add and remove the watches that changed."""
+    old = eventhandler.EventHandler.reload(self)
+    if old is not None and self.wm is not None:
+      self.update_watches(old.watches, self.watches)
+    return old
+
+  def watch_settings(self):
+    """Reload the config whenever the settings file is written or replaced."""
+    self.settings_path = os.path.realpath(self.settingsfile)
+    wm = pyinotify.WatchManager()
+    # Editors often save by writing a new file and renaming it over the
+    # old one, so watch the directory rather than the file.
+    wm.add_watch(os.path.dirname(self.settings_path), self.settings_mask,
+                 quiet=True)
+    self.settings_notifier = pyinotify.Notifier(wm, self.settings_changed)
+
+  def settings_changed(self, event):
+    if event.pathname == self.settings_path:
+      self.reload_requested = True
+
+  def poll_settings(self):
+    """Handle any pending events for the settings file, without blocking."""
+    notifier = self.settings_notifier
+    if notifier is not None and notifier.check_events(timeout=0):
+      notifier.read_events()
+      notifier.process_events()
+
+  def watch_dir(self, path, root, mask):
+    """Watch a single directory. Returns False if the watch failed."""
+    if len(self.watch_roots) >= self.watch_limit:
+      return False
+    wd = self.wm.add_watch(path, mask, quiet=True).get(path, -1)
+    if wd < 0:
+      return False
+    self.watch_roots[path] = root
+    return True
+
+  def watch_tree(self, top, root):
+    """
+    Watch every directory below top. If the watch limit is reached, the
+    rest of the tree is left unwatched and False is returned.
+
+    """
+    for path in scan.subdirectories(top):
+      if path not in self.watch_roots:
+        if not self.watch_dir(path, root, self.tree_mask):
+          print ("Could not watch {0} (max_user_watches is {1}), the rest "
+                "of {2} will not be watched.".format(path, self.watch_limit,
+                                                      root))
+          return False
+    return True
+
+  def watch_new_dir(self, event):
+    """
+    Watch a directory created in or moved into a recursive watch.
+    Files can appear in it before the watch is in place, so once it is
+    watched, anything already inside is dispatched as well.
+
+    """
+    root = self.watch_roots.get(event.path)
+    if root not in self.recursive_roots:
+      return
+    path = event.pathname
+    if self.watch_dir(path, root, self.tree_mask):
+      self.watch_tree(path, root)
+      for dirpath, filename in scan.files(path, recursive=True):
+        if os.path.join(dirpath, filename) not in self.in_progress:
+          self.dispatch_found(dirpath, filename)
+
+  def unwatch_tree(self, top):
+    """Remove the watches on top and every directory below it."""
+    prefix = top + os.sep
+    for path in [p for p in self.watch_roots
+                  if p == top or p.startswith(prefix)]:
+      if self.watch_roots[path] == path:
+        continue  # A watched location of its own
+      wd = self.wm.get_wd(path)
+      if wd is not None:
+        self.wm.rm_watch(wd, quiet=True)
+      del self.watch_roots[path]
+
   def start(self):
     wm = pyinotify.WatchManager()
-    mask = (pyinotify.IN_CREATE|pyinotify.IN_MOVED_TO|
-            pyinotify.IN_CLOSE_NOWRITE|pyinotify.IN_CLOSE_WRITE)
-    notifier = pyinotify.Notifier(wm, self)
-    for watch in self.watches:
-      wdd = wm.add_watch(os.path.expanduser(watch["location"]), mask)
-    notifier.loop()
+    timeout = self.tick and int(self.tick * 1000)
+    notifier = pyinotify.Notifier(wm, self, timeout=timeout)
+    self.add_watches(wm)
+    self.watch_settings()
+    if self.metrics is not None:
+      self.metrics.start()
+    if self.profiler is not None:
+      signal.signal(signal.SIGUSR1, self.profiler.start)
+    signal.signal(signal.SIGHUP, self.hangup)
+    if self.journal is not None:
+      self.replay_journal()
+    if self.state is not None:
+      self.start_catch_up()
+    try:
+      notifier.loop(callback=lambda notifier: self.on_tick())
+    finally:
+      self.shutdown()
+
+  def shutdown(self):
+    self.settle.flush()
+    eventhandler.EventHandler.shutdown(self)
+    if self.journal is not None:
+      self.journal.close()
+    if self.state is not None:
+      self.stopping.set()
+      if self.catch_up_thread is not None:
+        self.catch_up_thread.join()
+      self.state.close()
+    if self.settings_notifier is not None:
+      self.settings_notifier.stop()
+    if self.metrics is not None:
+      self.metrics.stop()
+    if self.tracer is not None:
+      self.tracer.close()
+    if self.profiler is not None:
+      self.profiler.stop()
+    if self.recorder is not None:
+      self.recorder.close()
@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import itertools
+import threading
+
+
+class Journal(object):
+  """
+  An append-only, on-disk journal of matched actions, giving at-least-once
+  delivery across crashes.
+
+  Every action is recorded with begin() before it runs and marked with
+  done() afterwards; a worker calls wait() on the ticket from begin()
+  before running the action, and an event loop, which mustn't block, has
+  when_durable() call it back instead. Records are JSON lines written by a single
+  writer thread, which writes everything queued since its last pass,
+  fsyncs once and wakes everyone waiting (group commit), so the cost of an
+  fsync is shared by all of the events that arrived during the previous
+  one. done() records are never waited on.
+
+  When the journal is opened, begin records without a matching done
+  record are available from unfinished() to be replayed. Once
+  compact_every records have been written, the file is rewritten with
+  only the unfinished records.
+
+  """
+  def __init__(self, filename, compact_every=100000):
+    self.filename = filename
+    self.compact_every = compact_every
+    self.cond = threading.Condition()
+    self.lines = []
+    self.queued = 0  # Sequence number of the last queued record
+    self.durable = 0  # Sequence number of the last record on disk
+    self.since_compact = 0
+    self.closing = False
+    self.callbacks = []  # (sequence number, callback) for when_durable
+    self.ids = itertools.count()
+    self.prefix = "{0:x}.".format(int(time.time() * 1000000))
+    self.outstanding = self._load()
+    self.file = open(filename, 'a')
+    self.thread = threading.Thread(target=self._write, name="ire-journal")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _load(self):
+    outstanding = {}
+    try:
+      with open(self.filename, 'r') as f:
+        line = "\n"
+        for line in f:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            continue  # Torn write from a crash
+          if record.get("done"):
+            outstanding.pop(record["id"], None)
+          else:
+            outstanding[record["id"]] = record
+      if not line.endswith("\n"):
+        with open(self.filename, 'a') as f:
+          f.write("\n")  # Keep new records off the end of a torn one
+    except IOError:
+      pass  # New journal
+    return outstanding
+
+  def unfinished(self):
+    """Return the records begun but never finished before the last exit."""
+    with self.cond:
+      return list(self.outstanding.values())
+
+  def _queue(self, record):
+    self.lines.append(json.dumps(record) + "\n")
+    self.queued += 1
+    self.cond.notify_all()
+    return self.queued
+
+  def begin(self, pathname, rule, action):
+    """Record an action that is about to run. Returns its ticket."""
+    record = {
+      "id": self.prefix + "{0:x}".format(next(self.ids)),
+      "path": pathname,
+      "rule": rule,
+      "action": action,
+    }
+    with self.cond:
+      self.outstanding[record["id"]] = record
+      return (record["id"], self._queue(record))
+
+  def wait(self, ticket):
+    """Block until the begin record for a ticket is on disk."""
+    with self.cond:
+      while self.durable < ticket[1]:
+        self.cond.wait()
+
+  def when_durable(self, ticket, callback):
+    """
+    Call callback() once the begin record for a ticket is on disk: right
+    away if it already is, otherwise from the writer thread.
+
+    """
+    with self.cond:
+      if self.durable < ticket[1]:
+        self.callbacks.append((ticket[1], callback))
+        return
+    callback()
+
+  def done(self, ticket):
+    """Mark the action for a ticket as finished."""
+    with self.cond:
+      self.outstanding.pop(ticket[0], None)
+      self._queue({"id": ticket[0], "done": True})
+
+  def _write(self):
+    while True:
+      with self.cond:
+        while not self.lines and not self.closing:
+          self.cond.wait()
+        lines, self.lines = self.lines, []
+        seq = self.queued
+        closing = self.closing
+      try:
+        if lines:
+          self.file.write("".join(lines))
+          self.file.flush()
+          os.fsync(self.file.fileno())
+          self.since_compact += len(lines)
+          if self.since_compact >= self.compact_every:
+            self._compact()
+      except (IOError, OSError) as e:
+        print "Could not write journal {0}: {1}".format(self.filename, e)
+      with self.cond:
+        self.durable = seq
+        self.cond.notify_all()
+        due = [cb for ticket_seq, cb in self.callbacks if ticket_seq <= seq]
+        self.callbacks = [(ticket_seq, cb) for ticket_seq, cb
+                          in self.callbacks if ticket_seq > seq]
+      for callback in due:
+        try:
+          callback()
+        except Exception as e:
+          print "Exception encountered in journal callback: {0}".format(e)
+      if closing and not lines:
+        return
+
+  def _compact(self):
+    """Rewrite the journal with only the unfinished records."""
+    with self.cond:
+      records = list(self.outstanding.values())
+    tmp = self.filename + ".tmp"
+    with open(tmp, 'w') as f:
+      for record in records:
+        f.write(json.dumps(record) + "\n")
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp, self.filename)
+    dirfd = os.open(os.path.dirname(os.path.abspath(self.filename)),
+                    os.O_RDONLY)
+    try:
+      os.fsync(dirfd)  # Make the rename itself durable
+    finally:
+      os.close(dirfd)
+    self.file.close()
+    self.file = open(self.filename, 'a')
+    self.since_compact = 0
+
+  def close(self):
+    """Write out everything queued and stop the writer thread."""
+    with self.cond:
+      self.closing = True
+      self.cond.notify_all()
+    self.thread.join()
+    self.file.close()
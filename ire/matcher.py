@@ -0,0 +1,196 @@
+import os
+import time
+
+import ire.patterns as pattern_module
+
+
+class Hits(dict):
+  """
+  The result of scanning a single file: a dict mapping pattern ids to
+  whether they matched. Prefix and suffix patterns are filled in by the
+  scan itself; every other pattern is evaluated the first time a rule
+  asks for it and remembered for the rest of the event.
+  Patterns are passed the attribute of the Hits named by their class's
+  subject (the filename unless stated otherwise): "filename", "pathname",
+  "stat" (the file's os.stat result, or None if it is gone) or "file"
+  (the Hits itself, for patterns that need more than one of these).
+  The file is stat'ed at most once per event, and only if a pattern asks.
+  Evaluations are only timed if timed is set or there is a trace.
+
+  """
+  __slots__ = ("filename", "pathname", "engine", "trace", "timed", "_stat")
+
+  def __init__(self, filename, pathname, engine, trace=None, timed=False):
+    dict.__init__(self)
+    self.filename = filename
+    self.pathname = pathname
+    self.engine = engine
+    self.trace = trace  # A Tracer to record each evaluation with, if any
+    self.timed = timed or trace is not None
+    self._stat = False
+
+  @property
+  def stat(self):
+    if self._stat is False:
+      try:
+        self._stat = os.stat(self.pathname)
+      except OSError:
+        self._stat = None
+    return self._stat
+
+  @property
+  def file(self):
+    return self
+
+  def __missing__(self, pid):
+    entry = self.engine.lazy.get(pid)
+    if not self.timed:
+      hit = entry is not None and bool(entry[0](getattr(self, entry[1])))
+      self[pid] = hit
+    else:
+      start = time.time()
+      hit = entry is not None and bool(entry[0](getattr(self, entry[1])))
+      self[pid] = hit
+      end = time.time()
+      self.engine.seconds[pid] += end - start
+      if self.trace is not None:
+        self.trace.span(self.engine.names[pid], start, end, {"hit": hit})
+    self.engine.evaluated[pid] += 1
+    if hit:
+      self.engine.passed[pid] += 1
+    return hit
+
+
+class MatchEngine(object):
+  """
+  Shared matching engine for every pattern in the loaded rules.
+
+  Each distinct (style, pattern) pair is given an id. StartsWithPattern
+  and EndsWithPattern strings are stored in a prefix and a suffix trie,
+  so a single walk over the filename finds all of them at once. Other
+  patterns (regexes, globs, ...) are compiled once and evaluated at most
+  once per filename, no matter how many rules use them.
+
+  Within a rule, patterns are evaluated cheapest first by the cost tier
+  their class declares (trie patterns are free, and always come first).
+  The engine also counts how often each other pattern passes and every
+  reorder_every evaluations a rule re-sorts them by expected cost: for
+  AND, the patterns most likely to fail cheaply come first, for OR the
+  ones most likely to pass.
+  AND and OR don't depend on order, so results never change. The time
+  spent evaluating each pattern is kept as well, for the metrics, when
+  the scan is timed.
+
+  """
+  reorder_every = 1000
+  # Relative cost of each tier in ire.patterns (0 is a trie lookup)
+  tier_weights = {0: 0.1, 1: 1.0, 2: 4.0, 3: 50.0, 4: 500.0}
+
+  def __init__(self):
+    self.ids = {}
+    self.prefixes = {}
+    self.suffixes = {}
+    self.lazy = {}
+    self.costs = []
+    self.evaluated = []
+    self.passed = []
+    self.seconds = []
+    self.names = []
+
+  def add(self, cls, pattern):
+    """Register a pattern and return its id."""
+    key = (cls, pattern)
+    if key in self.ids:
+      return self.ids[key]
+    pid = len(self.ids)
+    if cls is pattern_module.StartsWithPattern:
+      self._insert(self.prefixes, pattern, pid)
+    elif cls is pattern_module.EndsWithPattern:
+      self._insert(self.suffixes, pattern[::-1], pid)
+    elif hasattr(cls, "compile"):
+      self.lazy[pid] = (cls.compile(pattern), self.subject(cls))
+    else:
+      self.lazy[pid] = (lambda arg, match=cls.match: match(pattern, arg),
+                        self.subject(cls))
+    if pid in self.lazy:
+      tier = getattr(cls, "cost", pattern_module.COST_REGEX)
+    else:
+      tier = 0
+    self.costs.append(self.tier_weights.get(tier, tier))
+    self.evaluated.append(0)
+    self.passed.append(0)
+    self.seconds.append(0.0)
+    self.names.append(u"{0} {1}".format(cls.__name__, pattern))
+    self.ids[key] = pid
+    return pid
+
+  def rule(self, condition, pids):
+    """
+    Return a callable that applies condition (all or any) to the
+    patterns pids against the Hits of a scan.
+
+    """
+    if len(pids) == 1:
+      pid = pids[0]
+      return lambda hits: hits[pid]
+    state = [sorted(pids, key=lambda pid: self.costs[pid]), 0]
+
+    def match(hits):
+      state[1] += 1
+      if state[1] >= self.reorder_every:
+        state[0] = self.order(state[0], condition is all)
+        state[1] = 0
+      return condition(hits[pid] for pid in state[0])
+    return match
+
+  def order(self, pids, conjunction):
+    """
+    Sort patterns by cost over the chance of ending the evaluation:
+    failing, for a conjunction (AND), or passing otherwise (OR).
+    Trie patterns are already decided by the scan, and only their misses
+    are counted, so they stay first instead of being sorted.
+
+    """
+    def expected(pid):
+      passing = (self.passed[pid] + 1.0) / (self.evaluated[pid] + 2.0)
+      decisive = 1.0 - passing if conjunction else passing
+      return self.costs[pid] / decisive
+    lazy = self.lazy
+    return ([pid for pid in pids if pid not in lazy] +
+            sorted((pid for pid in pids if pid in lazy), key=expected))
+
+  @staticmethod
+  def subject(cls):
+    return getattr(cls, "subject", "filename")
+
+  @staticmethod
+  def _insert(trie, key, pid):
+    node = trie
+    for ch in key:
+      node = node.setdefault(ch, {})
+    node.setdefault(None, []).append(pid)
+
+  @staticmethod
+  def _walk(trie, key, hits):
+    node = trie
+    for pid in node.get(None, ()):
+      hits[pid] = True
+    for ch in key:
+      node = node.get(ch)
+      if node is None:
+        return
+      for pid in node.get(None, ()):
+        hits[pid] = True
+
+  def scan(self, filename, pathname, trace=None, timed=False):
+    """
+    Return the Hits for a file. With timed set (or a trace), the time
+    spent evaluating each pattern is added to self.seconds.
+
+    """
+    hits = Hits(filename, pathname, self, trace, timed)
+    if self.prefixes:
+      self._walk(self.prefixes, filename, hits)
+    if self.suffixes:
+      self._walk(self.suffixes, reversed(filename), hits)
+    return hits
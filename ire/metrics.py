@@ -0,0 +1,247 @@
+import os
+import bisect
+import socket
+import threading
+import time
+
+# Seconds, for latencies and action run times
+time_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0,
+                60.0)
+
+
+def _labels(names, values):
+  if not names:
+    return ""
+  return "{" + ",".join('{0}="{1}"'.format(name, unicode(value).replace(
+    "\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value
+    in zip(names, values)) + "}"
+
+
+class Counter(object):
+  """A count for each combination of label values."""
+  kind = "counter"
+
+  def __init__(self, name, help, labels=()):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.lock = threading.Lock()
+    self.values = {}
+
+  def inc(self, *values):
+    with self.lock:
+      self.values[values] = self.values.get(values, 0) + 1
+
+  def samples(self):
+    with self.lock:
+      values = self.values.items()
+    for labels, value in sorted(values):
+      yield self.name + _labels(self.labels, labels), value
+
+
+class Histogram(object):
+  """
+  Observations counted into fixed buckets (plus a sum and a count) for
+  each combination of label values. Observing a value is a binary search
+  and a few additions.
+
+  """
+  kind = "histogram"
+
+  def __init__(self, name, help, labels=(), buckets=time_buckets):
+    self.name = name
+    self.help = help
+    self.labels = labels
+    self.buckets = tuple(buckets)
+    self.lock = threading.Lock()
+    self.values = {}  # labels -> [count per bucket (and +Inf), sum]
+
+  def observe(self, value, *values):
+    ix = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      entry = self.values.get(values)
+      if entry is None:
+        entry = self.values[values] = [[0] * (len(self.buckets) + 1), 0.0]
+      entry[0][ix] += 1
+      entry[1] += value
+
+  def samples(self):
+    with self.lock:
+      values = [(labels, (list(counts), total)) for labels, (counts, total)
+                in self.values.items()]
+    names = self.labels + ("le",)
+    for labels, (counts, total) in sorted(values):
+      cumulative = 0
+      for bound, count in zip(self.buckets + ("+Inf",), counts):
+        cumulative += count
+        yield (self.name + "_bucket" + _labels(names, labels + (bound,)),
+               cumulative)
+      yield self.name + "_sum" + _labels(self.labels, labels), total
+      yield self.name + "_count" + _labels(self.labels, labels), cumulative
+
+
+class Callback(object):
+  """
+  A metric read when the metrics are exported: func returns a number, or
+  a dict mapping tuples of label values to numbers.
+
+  """
+  def __init__(self, name, help, kind, func, labels=()):
+    self.name = name
+    self.help = help
+    self.kind = kind
+    self.func = func
+    self.labels = labels
+
+  def samples(self):
+    values = self.func()
+    if not isinstance(values, dict):
+      values = {(): values}
+    for labels, value in sorted(values.items()):
+      yield self.name + _labels(self.labels, labels), value
+
+
+class Metrics(object):
+  """
+  The daemon's metrics, exported in the Prometheus text format.
+
+  Recording a value takes a lock and a dict lookup; anything that can be
+  read from the handler when the metrics are exported (queue depth,
+  pattern statistics from the match engine) is read then instead of
+  being recorded as it happens.
+  With a `textfile`, the metrics are written to it every `interval`
+  seconds (for node_exporter's textfile collector), replacing it
+  atomically. With a `socket`, a Unix socket at that path answers every
+  connection with the current metrics and closes it.
+
+  """
+  def __init__(self, textfile=None, interval=15.0, socket=None):
+    self.textfile = textfile
+    self.interval = interval
+    self.socket = socket
+    self.stopped = threading.Event()
+    self.threads = []
+    self.metrics = []
+    self.events = self.add(Counter("ire_events_total",
+      "Filesystem events received, by type.", ("type",)))
+    self.rule_matches = self.add(Counter("ire_rule_matches_total",
+      "Files matched, by rule.", ("rule",)))
+    self.action_seconds = self.add(Histogram("ire_action_seconds",
+      "Time taken to run an action, by action type.", ("action",)))
+    self.action_failures = self.add(Counter("ire_action_failures_total",
+      "Actions that raised an exception, by action type.", ("action",)))
+    self.latency = self.add(Histogram("ire_event_to_action_seconds",
+      "Time from the filesystem event to the end of an action, "
+      "by action type.", ("action",)))
+
+  def add(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  def watch(self, handler):
+    """Export the values read from a handler."""
+    self.add(Callback("ire_queued_actions",
+      "Files whose actions are waiting for a worker.", "gauge",
+      handler.executor.pending))
+    if hasattr(handler, "settle"):
+      self.add(Callback("ire_settling_files",
+        "Files waiting for their settle window to pass.", "gauge",
+        lambda: len(handler.settle)))
+    def patterns(field):
+      engine = handler.engine
+      values = getattr(engine, field)
+      return dict(((cls.__name__, pattern), values[pid]) for
+                  (cls, pattern), pid in engine.ids.items()
+                  if pid in engine.lazy)
+    self.add(Callback("ire_pattern_evaluations_total",
+      "Times a pattern was evaluated.", "counter",
+      lambda: patterns("evaluated"), ("style", "pattern")))
+    self.add(Callback("ire_pattern_seconds_total",
+      "Time spent evaluating a pattern.", "counter",
+      lambda: patterns("seconds"), ("style", "pattern")))
+
+  def action_finished(self, action_type, started, ok, received=None):
+    """Record an action that ran from started until now."""
+    now = time.time()
+    self.action_seconds.observe(now - started, action_type)
+    if not ok:
+      self.action_failures.inc(action_type)
+    if received is not None:
+      self.latency.observe(now - received, action_type)
+
+  def render(self):
+    """Return every metric in the Prometheus text format."""
+    lines = []
+    for metric in self.metrics:
+      lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+      lines.append("# TYPE {0} {1}".format(metric.name, metric.kind))
+      for name, value in metric.samples():
+        lines.append("{0} {1}".format(name, repr(float(value))))
+    return "\n".join(lines).encode("utf-8") + "\n"
+
+  def write(self):
+    """Replace the text file with the current metrics."""
+    tmp = self.textfile + ".tmp"
+    with open(tmp, 'w') as f:
+      f.write(self.render())
+    os.rename(tmp, self.textfile)
+
+  def start(self):
+    """Start exporting the metrics in the background."""
+    if self.textfile:
+      self._thread(self._write_loop, "ire-metrics-file")
+    if self.socket:
+      if os.path.exists(self.socket):
+        os.unlink(self.socket)  # Left over from a previous run
+      self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.server.bind(self.socket)
+      self.server.listen(8)
+      self._thread(self._serve, "ire-metrics-socket")
+
+  def _thread(self, target, name):
+    thread = threading.Thread(target=target, name=name)
+    thread.daemon = True
+    thread.start()
+    self.threads.append(thread)
+
+  def _write_loop(self):
+    while not self.stopped.wait(self.interval):
+      try:
+        self.write()
+      except (IOError, OSError) as e:
+        print "Could not write metrics {0}: {1}".format(self.textfile, e)
+
+  def _serve(self):
+    while not self.stopped.is_set():
+      try:
+        conn, addr = self.server.accept()
+      except socket.error:
+        continue  # Interrupted, or closed by stop()
+      try:
+        conn.sendall(self.render())
+      except socket.error:
+        pass
+      finally:
+        conn.close()
+
+  def stop(self):
+    """Stop exporting, writing the text file one last time."""
+    self.stopped.set()
+    if self.socket:
+      try:
+        self.server.shutdown(socket.SHUT_RDWR)  # Wakes up accept()
+      except socket.error:
+        pass
+      self.server.close()
+    for thread in self.threads:
+      thread.join(1.0)
+    if self.socket:
+      try:
+        os.unlink(self.socket)
+      except OSError:
+        pass
+    if self.textfile:
+      try:
+        self.write()
+      except (IOError, OSError) as e:
+        print "Could not write metrics {0}: {1}".format(self.textfile, e)
@@ -1,8 +1,28 @@
+import os
 import re
-import glob
+import stat
+import time
+import sqlite3
+import fnmatch
+import mimetypes
+import collections
+
+import ire.hashindex as hashindex
+
+mimetypes.init()  # Load the extension table once, up front
 
 pattern_list = ['RegexPattern', 'SimplePattern', 'StartsWithPattern',
-            'EndsWithPattern', 'MimetypePattern']
+            'EndsWithPattern', 'MimetypePattern', 'MagicMimetypePattern',
+            'SizeGreaterPattern', 'SizeLessPattern', 'OlderThanPattern',
+            'NewerThanPattern', 'OwnerPattern', 'PermissionsPattern',
+            'DuplicatePattern']
+
+
+# Cost tiers, cheapest first. Rules evaluate cheaper patterns first.
+COST_NAME = 1  # Simple string operations on the filename
+COST_REGEX = 2  # Regular expressions, globs and lookups
+COST_STAT = 3  # Needs an os.stat of the file
+COST_CONTENT = 4  # Reads the file's contents
 
 
 class PatternError(Exception):
@@ -23,11 +43,27 @@ class ExamplePattern(object):
   @staticmethod
   def match(pattern, arg):
     ''' pattern is the pattern string from the settings file
-        arg is the filename that triggered the event
+        arg is the filename that triggered the event, or its full
+        path for patterns with a subject other than "filename"
         Returns a boolean.
         Should capture all exceptions and reraise them as PatternErrors
         with the captured exception as the "InnerException"
     '''
+
+  @staticmethod
+  def compile(pattern):
+    ''' Optional. Called once when the config is loaded.
+        Returns a callable that accepts the filename and returns a
+        boolean, equivalent to calling match(pattern, filename).
+        Invalid patterns should raise a PatternError here rather than
+        on every event.
+    '''
+
+  subject = "pathname"  # Optional. What compiled patterns are passed
+                        # instead of the filename: "pathname", "stat"
+                        # (the os.stat result, or None) or "file" (an
+                        # object with all three as attributes).
+  cost = COST_REGEX  # Optional. One of the COST_* tiers, the default.
 """
 
 
@@ -36,28 +72,49 @@ class RegexPattern(object):
   """
   displayname = "matches regex"
   description = "A regular expression to match on."
-  
+  cost = COST_REGEX
+
   @staticmethod
   def match(pattern, arg):
     try:
       return re.search(pattern, arg)
     except Exception as e:
       raise PatternError(e)
+
+  @staticmethod
+  def compile(pattern):
+    try:
+      return re.compile(pattern).search
+    except Exception as e:
+      raise PatternError(e)
     
 
 class SimplePattern(object):
   """ A pattern that matches a simpler form of regex:
       Only *, ?, and [] are allowed.
+      Matching is done purely on the filename (fnmatch semantics), the
+      filesystem is never consulted.
   """
   displayname = "matches glob"
   description = "Completion on *, ?, or []"
-  
+  _cache = {}
+  cost = COST_REGEX
+
   @staticmethod
   def match(pattern, arg):
-    for f in glob.iglob(pattern):
-      if f == arg:
-        return True
-    return False
+    return SimplePattern.compile(pattern)(arg) is not None
+
+  @staticmethod
+  def compile(pattern):
+    try:
+      return SimplePattern._cache[pattern]
+    except KeyError:
+      try:
+        matcher = re.compile(fnmatch.translate(pattern)).match
+      except Exception as e:
+        raise PatternError(e)
+      SimplePattern._cache[pattern] = matcher
+      return matcher
     
 
 class StartsWithPattern(object):
@@ -65,31 +122,401 @@ class StartsWithPattern(object):
       the beginning of the string.
   """
   displayname = "starts with"
-  
+  cost = COST_NAME
+
   @staticmethod
   def match(pattern, arg):
     return arg.startswith(pattern)
 
+  @staticmethod
+  def compile(pattern):
+    return lambda arg: arg.startswith(pattern)
+
   
 class EndsWithPattern(object):
   """ A pattern that matches only if the pattern matches
       the end of the string.
   """
   displayname = "ends with"
-  
+  cost = COST_NAME
+
   @staticmethod
   def match(pattern, arg):
     return arg.endswith(pattern)
 
+  @staticmethod
+  def compile(pattern):
+    return lambda arg: arg.endswith(pattern)
+
 
 class MimetypePattern(object):
   """ A pattern that checks the filename against its
       guessed mimetype.
   """
   displayname = "mimetype is"
-  
+  cost = COST_REGEX
+
   @staticmethod
   def match(mimetype, arg):
-    import mimetypes
     return mimetype in mimetypes.guess_type(arg)
-      
+
+  @staticmethod
+  def compile(mimetype):
+    guess_type = mimetypes.guess_type
+    return lambda arg: mimetype in guess_type(arg)
+
+
+# (mimetype, ((offset, bytes), ...)) in the order they are tried.
+magic_signatures = [
+  ("image/png", ((0, "\x89PNG\r\n\x1a\n"),)),
+  ("image/jpeg", ((0, "\xff\xd8\xff"),)),
+  ("image/gif", ((0, "GIF87a"),)),
+  ("image/gif", ((0, "GIF89a"),)),
+  ("image/webp", ((0, "RIFF"), (8, "WEBP"))),
+  ("image/tiff", ((0, "II*\x00"),)),
+  ("image/tiff", ((0, "MM\x00*"),)),
+  ("image/bmp", ((0, "BM"),)),
+  ("application/pdf", ((0, "%PDF-"),)),
+  ("application/postscript", ((0, "%!PS"),)),
+  ("application/rtf", ((0, "{\\rtf"),)),
+  ("application/zip", ((0, "PK\x03\x04"),)),
+  ("application/zip", ((0, "PK\x05\x06"),)),
+  ("application/gzip", ((0, "\x1f\x8b"),)),
+  ("application/x-bzip2", ((0, "BZh"),)),
+  ("application/x-xz", ((0, "\xfd7zXZ\x00"),)),
+  ("application/x-7z-compressed", ((0, "7z\xbc\xaf\x27\x1c"),)),
+  ("application/x-rar-compressed", ((0, "Rar!\x1a\x07"),)),
+  ("application/x-tar", ((257, "ustar"),)),
+  ("application/x-sqlite3", ((0, "SQLite format 3\x00"),)),
+  ("application/x-executable", ((0, "\x7fELF"),)),
+  ("application/x-msdownload", ((0, "MZ"),)),
+  ("application/ogg", ((0, "OggS"),)),
+  ("audio/flac", ((0, "fLaC"),)),
+  ("audio/mpeg", ((0, "ID3"),)),
+  ("audio/mpeg", ((0, "\xff\xfb"),)),
+  ("audio/x-wav", ((0, "RIFF"), (8, "WAVE"))),
+  ("video/x-msvideo", ((0, "RIFF"), (8, "AVI "))),
+  ("video/x-matroska", ((0, "\x1a\x45\xdf\xa3"),)),
+  ("video/mp4", ((4, "ftyp"),)),
+]
+
+
+def compile_signatures(signatures):
+  """
+  Split magic signatures into a dict keyed by the first byte of the ones
+  that start at offset 0, and a list of the rest.
+
+  """
+  table = {}
+  other = []
+  for mimetype, parts in signatures:
+    if parts[0][0] == 0:
+      table.setdefault(parts[0][1][0], []).append((mimetype, parts))
+    else:
+      other.append((mimetype, parts))
+  return table, other
+
+
+class MagicMimetypePattern(object):
+  """ A pattern that checks the mimetype detected from the first
+      bytes of the file's contents, for files without a
+      (trustworthy) extension.
+      Files that are not recognised are text/plain if they look like
+      UTF-8 text and application/octet-stream otherwise.
+  """
+  displayname = "content type is"
+  description = "A mimetype detected from the file's contents."
+  subject = "file"
+  header_size = 4096
+  cache_size = 10000
+  _cache = collections.OrderedDict()  # (dev, ino, mtime) -> mimetype
+  _table, _other = compile_signatures(magic_signatures)
+  cost = COST_CONTENT
+
+  @staticmethod
+  def sniff(header):
+    """Return the mimetype of a file from its first bytes."""
+    cls = MagicMimetypePattern
+    if not header:
+      return None
+    for signatures in (cls._table.get(header[0], ()), cls._other):
+      for mimetype, parts in signatures:
+        if all(header.startswith(sig, offset) for offset, sig in parts):
+          return mimetype
+    if "\x00" not in header:
+      try:
+        # A multibyte character may have been cut off at the end
+        header[:-3].decode("utf-8")
+        return "text/plain"
+      except UnicodeDecodeError:
+        pass
+    return "application/octet-stream"
+
+  @staticmethod
+  def mimetype(pathname, st=None):
+    """
+    Return the detected mimetype of a file, reading at most header_size
+    bytes once per (dev, inode, mtime).
+
+    """
+    cls = MagicMimetypePattern
+    if st is None:
+      try:
+        st = os.stat(pathname)
+      except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+      return None
+    key = (st.st_dev, st.st_ino, st.st_mtime)
+    cache = cls._cache
+    if key in cache:
+      # Move it to the end, so the least recently used is evicted first
+      mimetype = cache[key] = cache.pop(key)
+      return mimetype
+    try:
+      fd = os.open(pathname, os.O_RDONLY)
+      try:
+        header = os.read(fd, cls.header_size)
+      finally:
+        os.close(fd)
+    except OSError:
+      return None
+    mimetype = cache[key] = cls.sniff(header)
+    if len(cache) > cls.cache_size:
+      cache.popitem(last=False)
+    return mimetype
+
+  @staticmethod
+  def match(mimetype, arg):
+    return MagicMimetypePattern.mimetype(arg) == mimetype
+
+  @staticmethod
+  def compile(mimetype):
+    detect = MagicMimetypePattern.mimetype
+    return lambda f: f.stat is not None and (
+      detect(f.pathname, f.stat) == mimetype)
+
+
+def parse_size(text):
+  """Parse a size such as "100", "500K" or "1.5GB" into bytes."""
+  match = re.match(r"^\s*([0-9.]+)\s*([KMGT]?)(?:i?B)?\s*$", text, re.I)
+  if match is None:
+    raise PatternError("Invalid size '{0}'".format(text))
+  number, unit = match.groups()
+  try:
+    return float(number) * 1024 ** " KMGT".index(unit.upper() or " ")
+  except ValueError as e:
+    raise PatternError(e)
+
+
+def parse_age(text):
+  """Parse an age such as "30s", "15m", "12h", "7d" or "2w" into seconds."""
+  match = re.match(r"^\s*([0-9.]+)\s*([smhdw]?)\s*$", text, re.I)
+  if match is None:
+    raise PatternError("Invalid age '{0}'".format(text))
+  number, unit = match.groups()
+  seconds = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+  try:
+    return float(number) * seconds[unit.lower()]
+  except ValueError as e:
+    raise PatternError(e)
+
+
+def _stat(pathname):
+  """Return os.stat(pathname), or None if the file is gone."""
+  try:
+    return os.stat(pathname)
+  except OSError:
+    return None
+
+
+# The patterns below look at the file itself, so match() takes its full
+# path rather than just the filename; a file that is gone never matches.
+
+class SizeGreaterPattern(object):
+  """ A pattern that matches files larger than a size, in bytes
+      or with a K, M, G or T suffix (eg. 1G).
+  """
+  displayname = "size larger than"
+  description = "A size such as 500K or 1G."
+  subject = "stat"
+  cost = COST_STAT
+
+  @staticmethod
+  def match(size, arg):
+    return SizeGreaterPattern.compile(size)(_stat(arg))
+
+  @staticmethod
+  def compile(size):
+    size = parse_size(size)
+    return lambda st: st is not None and st.st_size > size
+
+
+class SizeLessPattern(object):
+  """ A pattern that matches files smaller than a size, in bytes
+      or with a K, M, G or T suffix (eg. 1G).
+  """
+  displayname = "size smaller than"
+  description = "A size such as 500K or 1G."
+  subject = "stat"
+  cost = COST_STAT
+
+  @staticmethod
+  def match(size, arg):
+    return SizeLessPattern.compile(size)(_stat(arg))
+
+  @staticmethod
+  def compile(size):
+    size = parse_size(size)
+    return lambda st: st is not None and st.st_size < size
+
+
+class OlderThanPattern(object):
+  """ A pattern that matches files last modified longer ago
+      than an age, such as 7d.
+  """
+  displayname = "modified longer ago than"
+  description = "An age in s, m, h, d or w, such as 12h or 7d."
+  subject = "stat"
+  cost = COST_STAT
+
+  @staticmethod
+  def match(age, arg):
+    return OlderThanPattern.compile(age)(_stat(arg))
+
+  @staticmethod
+  def compile(age):
+    age = parse_age(age)
+    return lambda st: st is not None and st.st_mtime < time.time() - age
+
+
+class NewerThanPattern(object):
+  """ A pattern that matches files last modified more recently
+      than an age, such as 7d.
+  """
+  displayname = "modified within"
+  description = "An age in s, m, h, d or w, such as 12h or 7d."
+  subject = "stat"
+  cost = COST_STAT
+
+  @staticmethod
+  def match(age, arg):
+    return NewerThanPattern.compile(age)(_stat(arg))
+
+  @staticmethod
+  def compile(age):
+    age = parse_age(age)
+    return lambda st: st is not None and st.st_mtime >= time.time() - age
+
+
+class OwnerPattern(object):
+  """ A pattern that matches files owned by a user, given
+      by name or uid.
+  """
+  displayname = "owned by"
+  description = "A user name or uid."
+  subject = "stat"
+  cost = COST_STAT
+
+  @staticmethod
+  def match(owner, arg):
+    return OwnerPattern.compile(owner)(_stat(arg))
+
+  @staticmethod
+  def compile(owner):
+    if owner.isdigit():
+      uid = int(owner)
+    else:
+      try:
+        import pwd
+        uid = pwd.getpwnam(owner).pw_uid
+      except (ImportError, KeyError):
+        raise PatternError("Unknown user '{0}'".format(owner))
+    return lambda st: st is not None and st.st_uid == uid
+
+
+class PermissionsPattern(object):
+  """ A pattern that matches files that have all of the
+      permission bits in an octal mode set (eg. 111 for
+      executable by everyone, 4000 for setuid).
+  """
+  displayname = "has permissions"
+  description = "An octal mode such as 644 or 111."
+  subject = "stat"
+  cost = COST_STAT
+
+  @staticmethod
+  def match(mode, arg):
+    return PermissionsPattern.compile(mode)(_stat(arg))
+
+  @staticmethod
+  def compile(mode):
+    try:
+      mode = int(mode, 8)
+    except ValueError:
+      raise PatternError("Invalid mode '{0}'".format(mode))
+    return lambda st: st is not None and st.st_mode & mode == mode
+
+
+class DuplicatePattern(object):
+  """ A pattern that matches files whose contents are identical
+      to a file already somewhere below a directory.
+      The directory is indexed (by size, with content hashes
+      computed only for files of the same size) the first time
+      the pattern is used, in the file set with configure(index=...),
+      and watched for changes from then on.
+  """
+  displayname = "duplicates a file in"
+  description = "The directory to look for duplicates in."
+  subject = "file"
+  cost = COST_CONTENT
+  index_file = "~/.cache/ire/hashes.db"
+  _index = None
+
+  @staticmethod
+  def configure(index=None):
+    cls = DuplicatePattern
+    if index is not None:
+      # Relative to where the daemon was started, not wherever it is later
+      index = os.path.abspath(os.path.expanduser(index))
+    if index is not None and index != cls.index_file:
+      cls.index_file = index
+      if cls._index is not None:
+        cls._index.close()
+        cls._index = None
+
+  @staticmethod
+  def index(root):
+    """Return the hash index, with root brought up to date."""
+    cls = DuplicatePattern
+    if cls._index is None:
+      filename = os.path.expanduser(cls.index_file)
+      dirname = os.path.dirname(filename)
+      if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+      cls._index = hashindex.HashIndex(filename)
+    cls._index.refresh(root)
+    return cls._index
+
+  @staticmethod
+  def duplicate(root, pathname, st):
+    if st is None or not stat.S_ISREG(st.st_mode):
+      return False
+    try:
+      return DuplicatePattern.index(root).duplicate(root, pathname, st)
+    except (IOError, OSError, sqlite3.Error) as e:
+      raise PatternError(e)
+
+  @staticmethod
+  def match(directory, arg):
+    try:
+      st = os.stat(arg)
+    except OSError:
+      return False
+    return DuplicatePattern.duplicate(
+      os.path.normpath(os.path.expanduser(directory)), arg, st)
+
+  @staticmethod
+  def compile(directory):
+    root = os.path.normpath(os.path.expanduser(directory))
+    return lambda f: DuplicatePattern.duplicate(root, f.pathname, f.stat)
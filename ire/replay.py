@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import collections
+
+import pyinotify
+
+import ire.patterns as pattern_module
+import ire.inotifyhandler as inotifyhandler
+
+
+class Recorder(object):
+  """
+  Writes every inotify event the handler receives to a trace file, one
+  JSON object per line: the time it arrived, the raw mask, the watched
+  directory and name, the move cookie, the watch descriptor, whether it
+  was for a directory, and the location whose rules applied to it.
+  Files the handler dispatches without an event (found when a new
+  directory is scanned, or at startup by catch_up) are written as a
+  "found" record with the time, directory, name and location.
+
+  """
+  def __init__(self, filename):
+    self.filename = filename
+    self.lock = threading.Lock()
+    self.file = open(filename, 'a', 1 << 16)
+
+  def record(self, event, root):
+    self._write(json.dumps({
+      "t": time.time(),
+      "mask": event.mask,
+      "path": event.path,
+      "name": event.name,
+      "cookie": getattr(event, "cookie", None),
+      "wd": event.wd,
+      "dir": event.dir,
+      "root": root,
+    }))
+
+  def record_found(self, dirpath, filename, root):
+    self._write(json.dumps({
+      "t": time.time(),
+      "found": True,
+      "path": dirpath,
+      "name": filename,
+      "root": root,
+    }))
+
+  def _write(self, line):
+    with self.lock:
+      self.file.write(line + "\n")
+
+  def close(self):
+    with self.lock:
+      self.file.close()
+
+
+def read_trace(filename):
+  """Yield the records in a trace file, skipping any torn last line."""
+  with open(filename, 'r') as f:
+    for line in f:
+      try:
+        yield json.loads(line)
+      except ValueError:
+        continue
+
+
+class ReplayHandler(inotifyhandler.EventHandler):
+  """
+  An event handler for replaying traces. It matches events and prepares
+  actions as usual, but counts the actions instead of running them,
+  doesn't watch anything, and writes nothing the config points to: the
+  journal, state index, metrics exports, trace and profile are left off,
+  and DuplicatePattern keeps its index in a temporary directory that is
+  removed at shutdown.
+
+  """
+  def __init__(self, settingsfile):
+    self.actions_run = collections.defaultdict(int)
+    self.count_lock = threading.Lock()
+    self.scratch = tempfile.mkdtemp(prefix="ire-replay-")
+    inotifyhandler.EventHandler.__init__(self, settingsfile)
+
+  def load_config(self, settingsfile):
+    inotifyhandler.EventHandler.load_config(self, settingsfile)
+    self.options = dict(self.options, journal=None, state_db=None,
+                        metrics_file=None, metrics_socket=None,
+                        trace_file=None, profile_file=None)
+    pattern_module.DuplicatePattern.configure(
+      index=os.path.join(self.scratch, "hashes.db"))
+
+  def shutdown(self):
+    inotifyhandler.EventHandler.shutdown(self)
+    shutil.rmtree(self.scratch, ignore_errors=True)
+
+  def exe(self, action_type, kwdict):
+    with self.count_lock:
+      self.actions_run[(kwdict.get("_rule"), action_type)] += 1
+    return True
+
+  def async_trigger(self, action):
+    return None  # Counted by exe, like every other action
+
+  def watch_new_dir(self, event):
+    pass  # The trace has the directory's locations and the files found
+
+  def unwatch_tree(self, top):
+    pass
+
+
+class Replayer(object):
+  """
+  Feeds the events in a trace to a ReplayHandler, with the gaps between
+  them scaled by 1 / speed (so 1 is the original speed), or back to back
+  if speed is 0.
+
+  """
+  def __init__(self, configfile, tracefile, speed=1.0):
+    self.handler = ReplayHandler(configfile)
+    self.tracefile = tracefile
+    self.speed = speed
+    self.events = 0
+
+  def wait(self, due):
+    """Sleep until due, keeping the settle window running meanwhile."""
+    while True:
+      remaining = due - time.time()
+      if remaining <= 0:
+        return
+      time.sleep(min(remaining, 0.01))
+      self.handler.settle.run_due()
+
+  def run(self):
+    """Replay the whole trace, then print and return a summary."""
+    handler = self.handler
+    start = time.time()
+    first = None
+    for record in read_trace(self.tracefile):
+      if first is None:
+        first = record["t"]
+      if self.speed:
+        self.wait(start + (record["t"] - first) / self.speed)
+      handler.watch_roots.setdefault(record["path"], record["root"])
+      if record.get("found"):
+        handler.dispatch_found(record["path"], record["name"])
+        handler.settle.run_due()
+        self.events += 1
+        continue
+      handler(pyinotify.Event({
+        "wd": record["wd"],
+        "mask": record["mask"],
+        "cookie": record["cookie"],
+        "name": record["name"],
+        "path": record["path"],
+        "dir": record["dir"],
+      }))
+      handler.settle.run_due()
+      self.events += 1
+    handler.shutdown()  # Dispatches anything settling and waits for it
+    summary = self.status(time.time() - start)
+    sys.stderr.write(summary + "\n")
+    for (rule, action_type), count in sorted(handler.actions_run.items()):
+      sys.stderr.write("  {0}: {1} x {2}\n".format(rule, count, action_type))
+    return summary
+
+  def status(self, elapsed):
+    rate = self.events / elapsed if elapsed else 0
+    actions = sum(self.handler.actions_run.values())
+    return ("Replayed {0} events in {1:.1f}s ({2:.0f}/s), {3} actions "
+            "matched.".format(self.events, elapsed, rate, actions))
@@ -0,0 +1,64 @@
+"""
+Lazy directory walking.
+
+Uses os.scandir (or the scandir backport on Python 2) when available, so
+telling files from directories doesn't cost a stat per entry, and falls
+back to os.listdir and a single lstat per entry otherwise. Symlinks to
+directories are never followed.
+
+"""
+import os
+import stat
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+
+def entries(path):
+  """Yield (name, is_dir) for each entry in a directory."""
+  try:
+    if scandir is None:
+      names = os.listdir(path)
+    else:
+      it = scandir(path)
+  except OSError:
+    return  # Deleted or unreadable
+  if scandir is None:
+    for name in names:
+      try:
+        mode = os.lstat(os.path.join(path, name)).st_mode
+      except OSError:
+        continue  # Deleted meanwhile
+      yield name, stat.S_ISDIR(mode)
+  else:
+    for entry in it:
+      yield entry.name, entry.is_dir(follow_symlinks=False)
+
+
+def subdirectories(top):
+  """Yield every directory below top, parents before their children."""
+  stack = [top]
+  while stack:
+    dirpath = stack.pop()
+    for name, is_dir in entries(dirpath):
+      if is_dir:
+        path = os.path.join(dirpath, name)
+        yield path
+        stack.append(path)
+
+
+def files(top, recursive=False):
+  """Yield (dirpath, filename) for every non-directory in top."""
+  stack = [top]
+  while stack:
+    dirpath = stack.pop()
+    for name, is_dir in entries(dirpath):
+      if not is_dir:
+        yield dirpath, name
+      elif recursive:
+        stack.append(os.path.join(dirpath, name))
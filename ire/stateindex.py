@@ -0,0 +1,91 @@
+import time
+import sqlite3
+import threading
+import collections
+
+
+class StateIndex(object):
+  """
+  A SQLite record of the files that have already been handled, keyed by
+  (device, inode) and storing the mtime and size they had at the time.
+  A file is new or changed if its current (dev, ino, mtime, size) isn't
+  recorded.
+
+  Lookups are done in batches of up to batch_size files per query.
+  Records are written as they come in but only committed every
+  commit_every records or commit_interval seconds (and on close), so
+  handling a file doesn't cost a disk sync.
+
+  """
+  batch_size = 500
+  commit_every = 1000
+  commit_interval = 1.0
+
+  def __init__(self, filename):
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(filename, check_same_thread=False)
+    self.db.execute("CREATE TABLE IF NOT EXISTS handled ("
+                    "dev INTEGER, ino INTEGER, mtime REAL, size INTEGER, "
+                    "PRIMARY KEY (dev, ino))")
+    self.db.execute("CREATE TABLE IF NOT EXISTS locations "
+                    "(path TEXT PRIMARY KEY)")
+    self.db.commit()
+    self.uncommitted = 0
+    self.last_commit = time.time()
+
+  def known_location(self, path):
+    """Return True if a location has been scanned before."""
+    with self.lock:
+      return self.db.execute("SELECT 1 FROM locations WHERE path = ?",
+                             (path,)).fetchone() is not None
+
+  def add_location(self, path):
+    with self.lock:
+      self.db.execute("INSERT OR IGNORE INTO locations VALUES (?)", (path,))
+      self._changed(1)
+
+  def record(self, stats):
+    """Record a list of os.stat results as handled."""
+    with self.lock:
+      self.db.executemany("INSERT OR REPLACE INTO handled VALUES (?, ?, ?, ?)",
+        [(st.st_dev, st.st_ino, st.st_mtime, st.st_size) for st in stats])
+      self._changed(len(stats))
+
+  def unhandled(self, items):
+    """
+    Filter a list of (stat, ...) tuples down to the files that are new
+    or have changed since they were recorded.
+
+    """
+    by_dev = collections.defaultdict(list)
+    for item in items:
+      by_dev[item[0].st_dev].append(item)
+    found = []
+    with self.lock:
+      for dev, group in by_dev.items():
+        for ix in range(0, len(group), self.batch_size):
+          batch = group[ix:ix + self.batch_size]
+          rows = self.db.execute(
+            "SELECT ino, mtime, size FROM handled WHERE dev = ? AND "
+            "ino IN ({0})".format(", ".join("?" * len(batch))),
+            [dev] + [item[0].st_ino for item in batch])
+          known = dict((ino, (mtime, size)) for ino, mtime, size in rows)
+          found.extend(item for item in batch if
+            known.get(item[0].st_ino) != (item[0].st_mtime, item[0].st_size))
+    return found
+
+  def _changed(self, count):
+    self.uncommitted += count
+    if (self.uncommitted >= self.commit_every or
+        time.time() - self.last_commit >= self.commit_interval):
+      self._commit()
+
+  def _commit(self):
+    self.db.commit()
+    self.uncommitted = 0
+    self.last_commit = time.time()
+
+  def close(self):
+    with self.lock:
+      self._commit()
+      self.db.close()
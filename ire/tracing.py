@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import zlib
+import signal
+import thread
+import cProfile
+import threading
+
+
+class Tracer(object):
+  """
+  Writes spans (named, timed sections of work) for a sample of the files
+  the daemon handles to a file in the Chrome trace format, which can be
+  loaded in chrome://tracing or Perfetto.
+
+  One in every `sample` files is traced, chosen by a hash of its path so
+  that every thread agrees on it and all of a file's spans are kept:
+  matching, each pattern evaluated, argument substitution and each
+  action. Spans are buffered and written in batches.
+
+  """
+  batch_size = 1000
+
+  def __init__(self, filename, sample=100):
+    self.filename = filename
+    self.sample = max(1, int(sample))
+    self.lock = threading.Lock()
+    self.spans = []
+    self.pid = os.getpid()
+    self.file = open(filename, 'w')
+    self.file.write("[\n")
+    self.first = True
+
+  def sampled(self, pathname):
+    """Return True if a file's spans should be recorded."""
+    if isinstance(pathname, unicode):
+      pathname = pathname.encode("utf-8")
+    return zlib.crc32(pathname) % self.sample == 0
+
+  def span(self, name, start, end=None, args=None):
+    """Record a span that ran from start until end (or now)."""
+    if end is None:
+      end = time.time()
+    span = {
+      "name": name,
+      "ph": "X",
+      "ts": int(start * 1000000),
+      "dur": int((end - start) * 1000000),
+      "pid": self.pid,
+      "tid": thread.get_ident(),
+    }
+    if args:
+      span["args"] = args
+    with self.lock:
+      self.spans.append(span)
+      if len(self.spans) >= self.batch_size:
+        self._write()
+
+  def _write(self):
+    for span in self.spans:
+      self.file.write(("" if self.first else ",\n") + json.dumps(span))
+      self.first = False
+    self.file.flush()
+    self.spans = []
+
+  def close(self):
+    with self.lock:
+      self._write()
+      self.file.write("\n]\n")
+      self.file.close()
+
+
+class Profiler(object):
+  """
+  Profiles the event thread (matching and dispatching events) with
+  cProfile for `seconds` seconds from the moment start() is called, then
+  saves the stats to `filename` for pstats or a profile viewer. Meant to
+  be started from a signal handler; an interval timer (SIGALRM) ends
+  the window.
+
+  """
+  def __init__(self, filename, seconds=30):
+    self.filename = filename
+    self.seconds = seconds
+    self.profile = None
+
+  def start(self, signum=None, frame=None):
+    if self.profile is not None:
+      return  # Already profiling
+    self.profile = cProfile.Profile()
+    signal.signal(signal.SIGALRM, self.stop)
+    signal.setitimer(signal.ITIMER_REAL, self.seconds)
+    self.profile.enable()
+    print "Profiling for {0} seconds".format(self.seconds)
+
+  def stop(self, signum=None, frame=None):
+    if self.profile is None:
+      return
+    self.profile.disable()
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    try:
+      self.profile.dump_stats(self.filename)
+      print "Wrote profile to {0}".format(self.filename)
+    except (IOError, OSError) as e:
+      print "Could not write profile {0}: {1}".format(self.filename, e)
+    self.profile = None